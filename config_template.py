@@ -19,4 +19,11 @@ root_path = r'd:\Users\wawzat\OneDrive\Documents\House\PurpleAir\pa_map_plot' #M
 video_folder = 'videos'
 images_folder = 'images'
 data_folder = 'Data'
-metadata_folder = 'metadata'
\ No newline at end of file
+metadata_folder = 'metadata'
+cache_folder = 'cache'
+
+# Maximum size of the ThingSpeak response cache in MB
+cache_size_mb = 2048
+
+# Stored sensor metadata older than this many days is fetched again from PurpleAir
+metadata_max_age_days = 7
@@ -0,0 +1,265 @@
+'''Micro benchmarks for the data and rendering pipeline.
+
+   Each benchmark runs on synthetic data so no API keys or network access are needed.
+
+Usage:
+   python pa_bench.py <benchmark> [-n <repeat>]
+'''
+
+import io
+import timeit
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+
+def ts_payload(rows=7800, seed=0):
+   '''Returns a synthetic ThingSpeak feeds.csv response. entry_id is empty, as in the averaged feeds pa_get_df
+      requests.
+
+      Args:
+         rows: (int)
+         seed: (int)
+
+      Returns:
+         (bytes)
+   '''
+   rng = np.random.default_rng(seed)
+   start = datetime(2020, 9, 1)
+   lines = ["created_at,entry_id,field1,field2,field3,field4,field5,field6,field7,field8"]
+   values = rng.uniform(0, 300, (rows, 8))
+   for i in range(rows):
+      t = start + timedelta(minutes=10 * i)
+      v = values[i]
+      lines.append(
+         f"{t:%Y-%m-%d %H:%M:%S} UTC,,{v[0]:.3f},{v[1]:.3f},{v[2]:.3f},{int(v[3])},{-int(v[4] / 5)},"
+         f"{v[5] / 3:.1f},{v[6] / 3:.1f},{v[7]:.3f}"
+         )
+   return ("\n".join(lines) + "\n").encode('utf-8')
+
+
+def bench_parse(repeat):
+   '''ThingSpeak response parsing. decode + StringIO + inferred read_csv + rename + inferred to_datetime
+      against parse_ts_csv().'''
+   from pa_get_df import MAPPING, DROP_COLUMNS, parse_ts_csv
+
+   def legacy_parse(content):
+      df = pd.read_csv(io.StringIO(content.decode('utf-8')))
+      df = df.rename(columns=MAPPING)
+      df['created_at'] = pd.to_datetime(df['created_at'])
+      return df
+
+   content = ts_payload()
+   return {
+      'legacy': lambda: legacy_parse(content),
+      'parse_ts_csv': lambda: parse_ts_csv(content),
+      'parse_ts_csv drop': lambda: parse_ts_csv(content, DROP_COLUMNS),
+      }
+
+
+def render_inputs(size=1280, sensors=300, seed=0):
+   '''Returns a synthetic basemap, plot extent and frame of sensor readings for the render benchmarks.'''
+   rng = np.random.default_rng(seed)
+   map_plt = rng.random((size, size, 4), dtype=np.float32)
+   map_plt[..., 3] = 1
+   bbox = (-117.6, -117.4, 33.7, 33.9)
+   df = pd.DataFrame({
+      'Lon': rng.uniform(bbox[0], bbox[1], sensors),
+      'Lat': rng.uniform(bbox[2], bbox[3], sensors),
+      'PM2.5_ATM_ug/m3': rng.uniform(0, 250, sensors)
+      })
+   return map_plt, bbox, df
+
+
+def render_root():
+   '''Returns a temporary root path with an images folder for the render benchmarks.'''
+   import os
+   import tempfile
+   import config
+   root_path = tempfile.mkdtemp() + os.path.sep
+   os.makedirs(root_path + config.images_folder)
+   return root_path
+
+
+def bench_render(repeat):
+   '''Frame rendering. A full figure build per frame (plot_map) against the persistent renderers, saving png
+      files and in memory.'''
+   import matplotlib
+   matplotlib.use('Agg')
+   from pa_map_plot import plot_map, MapRenderer, BlitRenderer, RasterRenderer
+   root_path = render_root()
+   map_plt, bbox, df = render_inputs()
+   start_time = datetime(2020, 9, 1)
+   renderer = MapRenderer(root_path, map_plt, bbox, 'AQI', [20, 225], 18, 'd')
+   blit = BlitRenderer(root_path, map_plt, bbox, 'AQI', [20, 225], 18, 'd')
+   raster = RasterRenderer(root_path, map_plt, bbox, 'AQI', [20, 225], 18, 'd')
+   return {
+      'plot_map': lambda: plot_map(root_path, df, map_plt, 1, start_time, bbox, 'AQI', [20, 225], 18, 'd'),
+      'MapRenderer': lambda: renderer.save(df, 1, start_time),
+      'BlitRenderer': lambda: blit.save(df, 1, start_time),
+      'RasterRenderer': lambda: raster.save(df, 1, start_time),
+      'MapRenderer.render': lambda: renderer.render(df, start_time),
+      'BlitRenderer.render': lambda: blit.render(df, start_time),
+      'RasterRenderer.render': lambda: raster.render(df, start_time),
+      }
+
+
+def bench_stream(repeat):
+   '''Frames to video, 10 frames. png files read back by the encoder against frames streamed in memory.'''
+   import os
+   import cv2
+   import matplotlib
+   matplotlib.use('Agg')
+   from pa_map_plot import MapRenderer
+   from pa_map_vid import VideoStream
+   root_path = render_root()
+   map_plt, bbox, df = render_inputs()
+   start_time = datetime(2020, 9, 1)
+   renderer = MapRenderer(root_path, map_plt, bbox, 'AQI', [20, 225], 18, 'd')
+   vid_path = os.path.join(root_path, 'bench.mp4')
+
+   def png_files():
+      video = None
+      for fig_num in range(1, 11):
+         renderer.save(df, fig_num, start_time)
+         frame = cv2.imread(renderer.frame_path(fig_num))
+         if video is None:
+            video = cv2.VideoWriter(vid_path, cv2.VideoWriter_fourcc(*'mp4v'), 15, (frame.shape[1], frame.shape[0]))
+         video.write(frame)
+      video.release()
+
+   def streamed():
+      stream = VideoStream(vid_path, 15)
+      for fig_num in range(1, 11):
+         stream.write(renderer.render(df, start_time))
+      stream.close()
+
+   return {
+      'png files': png_files,
+      'VideoStream': streamed,
+      }
+
+
+def bench_frames(repeat):
+   '''Frame slicing. Two created_at comparisons over all readings per frame against the FrameIndex slices and
+      the SensorMatrix columns.'''
+   from pa_frames import FrameIndex
+   from pa_matrix import SensorMatrix
+   rng = np.random.default_rng(0)
+   sensors, days, interval = 200, 7, timedelta(minutes=10)
+   start_time = pd.Timestamp('2020-09-01', tz='UTC')
+   frame_times = list(pd.date_range(start_time, start_time + timedelta(days=days), freq=interval))
+   created_at = np.tile(pd.date_range(start_time, periods=len(frame_times), freq=interval).asi8, sensors)
+   created_at = created_at + rng.integers(0, 600, len(created_at)) * 10**9
+   readings = pd.DataFrame({
+      'sensor_code': np.repeat(np.arange(sensors, dtype=np.int32), len(frame_times)),
+      'created_at': pd.to_datetime(created_at, utc=True),
+      'PM2.5_ATM_ug/m3': rng.uniform(0, 250, len(created_at)).astype(np.float32)
+      })
+
+   def masked():
+      for start in frame_times:
+         readings[(readings['created_at'] >= start) & (readings['created_at'] <= start + interval)]
+
+   def indexed():
+      frame_index = FrameIndex(readings, frame_times, interval)
+      for n in range(len(frame_index)):
+         frame_index.frame(n)
+
+   def matrix():
+      sensor_matrix = SensorMatrix.from_readings(readings, sensors, frame_times, interval)
+      for n in range(len(sensor_matrix)):
+         sensor_matrix.frame(n)
+
+   def matrix_filled():
+      sensor_matrix = SensorMatrix.from_readings(readings, sensors, frame_times, interval).smooth(3).ffill(3)
+      for n in range(len(sensor_matrix)):
+         sensor_matrix.frame(n)
+
+   return {
+      'mask': masked,
+      'FrameIndex': indexed,
+      'SensorMatrix': matrix,
+      'SensorMatrix smooth ffill': matrix_filled,
+      }
+
+
+def bench_heatmap(repeat):
+   '''Heatmap surface, 300 sensors on a 320x320 grid. Inverse distance weights computed per frame against the
+      precomputed IDWGrid weights.'''
+   from pa_heatmap import IDWGrid
+   map_plt, bbox, df = render_inputs()
+   rng = np.random.default_rng(1)
+   df = df.assign(sensor_code=np.arange(len(df)))
+   df.loc[rng.random(len(df)) < 0.2, 'PM2.5_ATM_ug/m3'] = np.nan
+   shape = (320, 320)
+   grid = IDWGrid(df.Lon, df.Lat, bbox, shape)
+
+   def per_frame():
+      # Every sensor weighted in every cell, recomputed for the frame.
+      frame = df.dropna()
+      scale = np.cos(np.radians((bbox[2] + bbox[3]) / 2))
+      x = (bbox[0] + (np.arange(shape[1]) + 0.5) * (bbox[1] - bbox[0]) / shape[1]) * scale
+      y = bbox[3] - (np.arange(shape[0]) + 0.5) * (bbox[3] - bbox[2]) / shape[0]
+      x, y = np.meshgrid(x, y)
+      d2 = (x[..., None] - frame.Lon.to_numpy() * scale) ** 2 + (y[..., None] - frame.Lat.to_numpy()) ** 2
+      weights = 1 / np.maximum(d2, 1e-12)
+      return (weights * frame['PM2.5_ATM_ug/m3'].to_numpy()).sum(axis=2) / weights.sum(axis=2)
+
+   return {
+      'per frame': per_frame,
+      'IDWGrid build': lambda: IDWGrid(df.Lon, df.Lat, bbox, shape),
+      'IDWGrid.frame_surface': lambda: grid.frame_surface(df),
+      }
+
+
+BENCHMARKS = {
+   'parse': bench_parse,
+   'render': bench_render,
+   'frames': bench_frames,
+   'stream': bench_stream,
+   'heatmap': bench_heatmap,
+   }
+
+
+def run(name, repeat):
+   cases = BENCHMARKS[name](repeat)
+   print(f"{name}: {BENCHMARKS[name].__doc__.split('.')[0]}")
+   baseline = None
+   for case, func in cases.items():
+      func()
+      seconds = min(timeit.repeat(func, number=1, repeat=repeat))
+      if baseline is None:
+         baseline = seconds
+      print(f"   {case:<24} {seconds * 1000:9.2f} ms   {baseline / seconds:6.2f}x")
+
+
+if __name__ == "__main__":
+   import argparse
+
+   def get_arguments():
+      parser = argparse.ArgumentParser(
+      description='run pipeline micro benchmarks on synthetic data.',
+      prog='pa_bench',
+      usage='%(prog)s <benchmark> [-n <repeat>]',
+      formatter_class=argparse.RawDescriptionHelpFormatter,
+      )
+      g=parser.add_argument_group(title='arguments',
+            description='''    benchmark     required.  one of: ''' + ', '.join(BENCHMARKS) + ''', all.
+    -n  --repeat                          optional.  number of timed runs. the fastest is reported.        ''')
+      g.add_argument('benchmark',
+                     type=str,
+                     choices = list(BENCHMARKS) + ['all'],
+                     help=argparse.SUPPRESS)
+      g.add_argument('-n', '--repeat',
+                     type=int,
+                     default = 5,
+                     dest='repeat',
+                     help=argparse.SUPPRESS)
+      args = parser.parse_args()
+      return(args)
+
+   args = get_arguments()
+   names = list(BENCHMARKS) if args.benchmark == 'all' else [args.benchmark]
+   for name in names:
+      run(name, args.repeat)
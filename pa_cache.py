@@ -0,0 +1,124 @@
+'''Local on-disk cache of ThingSpeak chunk responses.
+
+   Responses are stored as the raw csv returned by ThingSpeak, one file per (channel id, start, end, average)
+   request. History for a past day does not change so completed chunks are served from disk on later runs.
+   Chunks that end today or later are still open-ended and are always fetched again.
+
+   The cache is capped at a total size in bytes. When the cap is exceeded the least recently used files
+   are deleted. File modification times record the last use so the order survives between runs.
+'''
+
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+
+class ResponseCache:
+   '''Size capped, least recently used cache of ThingSpeak responses.
+
+      Args:
+         cache_path: (str)
+            folder for the cached response files
+         max_bytes: (int)
+            maximum total size of the cached files
+   '''
+   def __init__(self, cache_path, max_bytes):
+      os.makedirs(cache_path, exist_ok=True)
+      self.cache_path = cache_path
+      self.max_bytes = max_bytes
+      self.lock = threading.Lock()
+      self.hits = 0
+      self.misses = 0
+      self.uncached = 0
+      # file name -> size, least recently used first
+      self.entries = OrderedDict()
+      files = [f for f in os.scandir(cache_path) if f.is_file() and f.name.endswith(".csv")]
+      for f in sorted(files, key=lambda f: f.stat().st_mtime):
+         self.entries[f.name] = f.stat().st_size
+      self.total_bytes = sum(self.entries.values())
+      with self.lock:
+         self.evict()
+
+   @staticmethod
+   def key_name(key):
+      '''Returns the file name for a (channel id, start, end, average) key.'''
+      return "_".join(str(k) for k in key) + ".csv"
+
+   @staticmethod
+   def cacheable(key):
+      '''Returns True if the chunk ended before the current UTC day and can no longer change.'''
+      end = datetime.strptime(str(key[2]), "%Y%m%d").date()
+      return end < datetime.now(timezone.utc).date()
+
+   def get(self, key):
+      '''Returns the cached response content for key or None.
+
+         Args:
+            key: (tuple)
+               (channel id, start, end, average)
+
+         Returns:
+            (bytes)
+      '''
+      if not self.cacheable(key):
+         with self.lock:
+            self.uncached += 1
+         return None
+      name = self.key_name(key)
+      full_path = os.path.join(self.cache_path, name)
+      with self.lock:
+         if name not in self.entries:
+            self.misses += 1
+            return None
+         self.entries.move_to_end(name)
+      try:
+         with open(full_path, 'rb') as f:
+            content = f.read()
+         os.utime(full_path)
+      except FileNotFoundError:
+         with self.lock:
+            self.total_bytes -= self.entries.pop(name, 0)
+            self.misses += 1
+         return None
+      with self.lock:
+         self.hits += 1
+      return content
+
+   def put(self, key, content):
+      '''Stores the response content for a completed chunk and evicts the least recently used files if the
+         cache is over its size cap.
+
+         Args:
+            key: (tuple)
+               (channel id, start, end, average)
+            content: (bytes)
+      '''
+      if not self.cacheable(key):
+         return
+      name = self.key_name(key)
+      full_path = os.path.join(self.cache_path, name)
+      tmp_path = full_path + "." + str(threading.get_ident()) + ".tmp"
+      with open(tmp_path, 'wb') as f:
+         f.write(content)
+      os.replace(tmp_path, full_path)
+      with self.lock:
+         self.total_bytes += len(content) - self.entries.pop(name, 0)
+         self.entries[name] = len(content)
+         self.evict()
+
+   def evict(self):
+      '''Deletes the least recently used files until the cache is within its size cap. Caller holds the lock.'''
+      while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+         old_name, size = self.entries.popitem(last=False)
+         self.total_bytes -= size
+         try:
+            os.remove(os.path.join(self.cache_path, old_name))
+         except FileNotFoundError:
+            pass
+
+   def report(self):
+      '''Prints the cache hit and miss counts.'''
+      print(" ")
+      print(f"ThingSpeak cache: {self.hits} hits, {self.misses} misses, {self.uncached} open-ended chunks fetched, "
+            f"{len(self.entries)} files {self.total_bytes / 1e6:.1f} MB")
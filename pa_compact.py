@@ -0,0 +1,152 @@
+'''Compact, normalized layout for sensor readings.
+
+   The wide pa_get_df frame repeats the constant Lon, Lat and Sensor name of a sensor on every reading. The
+   compact layout splits it into two tables:
+      sensors    one row per sensor, indexed by an integer sensor_code. Lon, Lat, Sensor (categorical) and
+                 the PurpleAir sensor_index.
+      readings   one row per reading with the integer sensor_code, created_at and float32 measurements.
+
+   Helpers join the two back together, either the coordinates only for a slice of readings being plotted or
+   the full wide frame in chunks for writing csv files.
+'''
+
+import numpy as np
+import pandas as pd
+
+
+SENSOR_COLUMNS = ['Lon', 'Lat', 'Sensor']
+FLOAT32_COLUMNS = [
+   'PM1.0_CF1_ug/m3',
+   'PM2.5_CF1_ug/m3',
+   'PM10.0_CF1_ug/m3',
+   'UptimeMinutes',
+   'RSSI_dbm',
+   'Temperature_F',
+   'Humidity_%',
+   'PM2.5_ATM_ug/m3'
+   ]
+
+
+def sensor_table(sensor_ids):
+   '''Builds the sensor dimension table from the PurpleAir sensor list. The sensor_code of a sensor is its
+      position in the list.
+
+      Args:
+         sensor_ids: (list, list)
+
+      Returns:
+         (Pandas dataframe)
+   '''
+   sensors = pd.DataFrame({
+      'Lon': [sensor[3] for sensor in sensor_ids],
+      'Lat': [sensor[2] for sensor in sensor_ids],
+      'Sensor': pd.Categorical([sensor[1] for sensor in sensor_ids]),
+      'sensor_index': [sensor[0] for sensor in sensor_ids]
+      })
+   sensors.index.name = 'sensor_code'
+   return sensors
+
+
+def compact_dtypes(readings):
+   '''Narrows the measurement columns of a readings table to float32 and the AQI to int16.
+
+      Args:
+         readings: (Pandas dataframe)
+
+      Returns:
+         (Pandas dataframe)
+   '''
+   dtypes = {column: np.float32 for column in FLOAT32_COLUMNS if column in readings.columns}
+   if 'Ipm25' in readings.columns:
+      dtypes['Ipm25'] = np.int16
+   if 'sensor_code' in readings.columns:
+      dtypes['sensor_code'] = np.int32
+   return readings.astype(dtypes)
+
+
+def compact_readings(df):
+   '''Splits a wide frame with Lon, Lat and Sensor columns into the sensors and readings tables.
+
+      Args:
+         df: (Pandas dataframe)
+
+      Returns:
+         (Pandas dataframe, Pandas dataframe) sensors, readings
+   '''
+   codes = df.groupby(SENSOR_COLUMNS, sort=False, dropna=False, observed=True).ngroup().to_numpy(np.int32)
+   sensors = df[SENSOR_COLUMNS].drop_duplicates().reset_index(drop=True)
+   sensors['Sensor'] = sensors['Sensor'].astype('category')
+   sensors.index.name = 'sensor_code'
+   readings = df.drop(columns=SENSOR_COLUMNS)
+   readings.insert(0, 'sensor_code', codes)
+   return sensors, compact_dtypes(readings.reset_index(drop=True))
+
+
+def sensor_coords(readings, sensors):
+   '''Returns the longitude and latitude of each reading.
+
+      Args:
+         readings: (Pandas dataframe)
+         sensors: (Pandas dataframe)
+
+      Returns:
+         (numpy array, numpy array) lon, lat
+   '''
+   codes = readings['sensor_code'].to_numpy()
+   return sensors['Lon'].to_numpy()[codes], sensors['Lat'].to_numpy()[codes]
+
+
+def with_coords(readings, sensors):
+   '''Returns a copy of readings with Lon and Lat columns for plotting. Intended for the small slice of
+      readings in a frame rather than the whole table.
+
+      Args:
+         readings: (Pandas dataframe)
+         sensors: (Pandas dataframe)
+
+      Returns:
+         (Pandas dataframe)
+   '''
+   lon, lat = sensor_coords(readings, sensors)
+   return readings.assign(Lon=lon, Lat=lat)
+
+
+def expand_readings(sensors, readings):
+   '''Joins the sensors and readings tables back into the wide layout written by pa_get_df.
+
+      Args:
+         sensors: (Pandas dataframe)
+         readings: (Pandas dataframe)
+
+      Returns:
+         (Pandas dataframe)
+   '''
+   codes = readings['sensor_code'].to_numpy()
+   df = readings.drop(columns='sensor_code')
+   df.insert(0, 'Sensor', np.asarray(sensors['Sensor'], dtype=object)[codes])
+   df.insert(0, 'Lat', sensors['Lat'].to_numpy()[codes])
+   df.insert(0, 'Lon', sensors['Lon'].to_numpy()[codes])
+   return df
+
+
+def iter_expanded(sensors, readings, chunksize=500000):
+   '''Yields the wide layout in chunks of rows so it never has to be held in memory at once.'''
+   for start in range(0, len(readings), chunksize):
+      yield expand_readings(sensors, readings.iloc[start:start + chunksize])
+
+
+def to_csv(sensors, readings, csv_path, chunksize=500000):
+   '''Writes the wide layout to a csv file in chunks.
+
+      Args:
+         sensors: (Pandas dataframe)
+         readings: (Pandas dataframe)
+         csv_path: (str)
+         chunksize: (int)
+   '''
+   header = True
+   for df in iter_expanded(sensors, readings, chunksize):
+      df.to_csv(csv_path, mode='w' if header else 'a', index=False, header=header)
+      header = False
+   if header:
+      expand_readings(sensors, readings).to_csv(csv_path, index=False, header=True)
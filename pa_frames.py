@@ -0,0 +1,170 @@
+'''Time bucket index of the readings shown in each map frame.
+
+   A frame shows the readings from its start time to its start time plus the frame interval, both ends
+   included. Rather than comparing every reading against every frame, the reading times are sorted once and
+   the first and last reading of each frame are found with a binary search. Each frame is then a slice.
+
+   The frames rendered by a job are listed in order in a frame manifest, a csv file in the images folder with
+   the frame number, image file name, timestamp and frame_key of each frame. The video is encoded from the
+   manifest rather than by scanning and sorting the images folder.
+'''
+
+import csv
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+
+
+def utc_datetime64(values):
+   '''Returns datetimes as a numpy datetime64[ns] array in UTC.
+
+      Args:
+         values: (Pandas series, list, datetime)
+
+      Returns:
+         (numpy array)
+   '''
+   index = pd.DatetimeIndex(values)
+   if index.tz is not None:
+      index = index.tz_convert('UTC').tz_localize(None)
+   return index.values.astype('datetime64[ns]')
+
+
+def frame_key(readings, label, column='PM2.5_ATM_ug/m3'):
+   '''Returns a digest of what a frame shows, the sensors and readings plotted and the timestamp label. Frames
+      with the same key render to the same image.
+
+      Args:
+         readings: (Pandas dataframe)
+            compact readings of the frame
+         label: (str)
+         column: (str)
+
+      Returns:
+         (bytes)
+   '''
+   digest = hashlib.blake2b(digest_size=16)
+   digest.update(np.ascontiguousarray(readings['sensor_code'].to_numpy()).tobytes())
+   digest.update(np.ascontiguousarray(readings[column].to_numpy()).tobytes())
+   digest.update(label.encode('utf-8'))
+   return digest.digest()
+
+
+class FrameIndex:
+   '''Index of the readings in each frame.
+
+      Args:
+         readings: (Pandas dataframe)
+            with a created_at column
+         frame_times: (list, datetime)
+            start time of each frame
+         time_increment: (timedelta)
+         carry: (int)
+            number of frames in a row without readings that show the readings of the last frame with readings.
+   '''
+   def __init__(self, readings, frame_times, time_increment, carry=0):
+      self.readings = readings
+      self.frame_times = list(frame_times)
+      self.time_increment = time_increment
+      times = utc_datetime64(readings['created_at'])
+      self.order = np.argsort(times, kind='stable')
+      times = times[self.order]
+      starts = utc_datetime64(self.frame_times)
+      self.lo = np.searchsorted(times, starts, side='left')
+      self.hi = np.searchsorted(times, starts + np.timedelta64(time_increment), side='right')
+      self.source_times = list(self.frame_times)
+      self.carried = 0
+      if carry > 0:
+         self.carry_forward(carry)
+
+   def carry_forward(self, carry):
+      '''Points frames without readings at the readings of the last frame with readings, for up to carry
+         frames in a row.'''
+      frames = np.arange(len(self.lo))
+      empty = self.lo == self.hi
+      last = np.maximum.accumulate(np.where(empty, -1, frames))
+      carried = empty & (last >= 0) & (frames - last <= carry)
+      self.lo[carried] = self.lo[last[carried]]
+      self.hi[carried] = self.hi[last[carried]]
+      for n in np.flatnonzero(carried):
+         self.source_times[n] = self.frame_times[last[n]]
+      self.carried = int(carried.sum())
+
+   def __len__(self):
+      return len(self.frame_times)
+
+   def positions(self, n):
+      '''Returns the row positions of the readings in frame n (from 0) in their original order.'''
+      return np.sort(self.order[self.lo[n]:self.hi[n]])
+
+   def frame(self, n):
+      '''Returns the readings in frame n (from 0).'''
+      return self.readings.iloc[self.positions(n)]
+
+   def label_time(self, n, stamp='frame'):
+      '''Returns the time shown on frame n (from 0). The frame start time, or with stamp 'data' the start
+         time of the frame the readings were carried from.'''
+      return self.source_times[n] if stamp == 'data' else self.frame_times[n]
+
+   def every(self, step):
+      '''Returns the index of every step-th frame, starting with the first.'''
+      frames = FrameIndex.__new__(FrameIndex)
+      frames.__dict__.update(self.__dict__)
+      frames.frame_times = self.frame_times[::step]
+      frames.source_times = self.source_times[::step]
+      frames.lo = self.lo[::step]
+      frames.hi = self.hi[::step]
+      return frames
+
+   def run(self, first, last):
+      '''Returns the index of frames first to last (from 0, inclusive) holding only the readings they show.'''
+      run = FrameIndex.__new__(FrameIndex)
+      start = int(self.lo[first:last + 1].min()) if last >= first else 0
+      stop = int(self.hi[first:last + 1].max()) if last >= first else 0
+      positions = np.sort(self.order[start:stop])
+      run.readings = self.readings.iloc[positions]
+      run.frame_times = self.frame_times[first:last + 1]
+      run.time_increment = self.time_increment
+      run.order = np.searchsorted(positions, self.order[start:stop])
+      run.lo = self.lo[first:last + 1] - start
+      run.hi = self.hi[first:last + 1] - start
+      run.source_times = self.source_times[first:last + 1]
+      run.carried = 0
+      return run
+
+
+manifest_columns = ['index', 'path', 'timestamp', 'hash']
+
+
+def write_frame_manifest(manifest_path, rows):
+   '''Writes a frame manifest. The file is replaced whole, so readers never see a partial manifest.
+
+      Args:
+         manifest_path: (str)
+         rows: (list, tuple)
+            index, image file name relative to the manifest folder, timestamp and hash of each frame
+   '''
+   with open(manifest_path + '.tmp', 'w', newline='') as f:
+      writer = csv.writer(f)
+      writer.writerow(manifest_columns)
+      writer.writerows(sorted(rows))
+   os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def read_frame_manifest(manifest_path):
+   '''Returns the frames of a frame manifest in order, with the image paths joined to the manifest folder.
+
+      Args:
+         manifest_path: (str)
+
+      Returns:
+         (list, dict) index, path, timestamp and hash of each frame
+   '''
+   folder = os.path.dirname(manifest_path)
+   with open(manifest_path, 'r', newline='') as f:
+      rows = list(csv.DictReader(f))
+   for row in rows:
+      row['index'] = int(row['index'])
+      row['path'] = os.path.join(folder, row['path'])
+   return rows
@@ -38,61 +38,94 @@ from requests.packages.urllib3.util.retry import Retry
 import json
 import config
 import pandas as pd
+import numpy as np
 import os
-from time import sleep
+from time import sleep, monotonic
 import math
-from collections import defaultdict
-import ast
+from collections import defaultdict, deque
 import io
+import threading
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from pa_cache import ResponseCache
+from pa_job import JobManifest
+from pa_metadata import MetadataStore
+from pa_compact import sensor_table, expand_readings
 
 
-def get_sensor_indexes(bbox, filename):
-   '''Gets list of sensor indexes (aka ID's) from the PurpleAir API for sensors located within a bounding box.
+def get_metadata_store():
+   '''Opens the sensor metadata store in the metadata folder.
+
+      Returns:
+         (pa_metadata.MetadataStore)
+   '''
+   metadata_path = config.root_path + os.path.sep + config.metadata_folder 
+   return MetadataStore(
+      metadata_path + os.path.sep + 'sensors.db',
+      getattr(config, 'metadata_max_age_days', 7)
+      )
+
+
+def get_sensor_indexes(bbox, filename=None, metadata=False):
+   '''Gets list of sensor indexes (aka ID's) for sensors located within a bounding box. Bounding boxes inside
+      an area already in the metadata store are answered locally, otherwise the PurpleAir API is queried and
+      the results are added to the store.
 
       Args:
          bbox (list, float)
             bounding box coordinates in the format lat1 lon1 lat2 lon2 for the SE and NW corners respectively
+         filename: (str)
+            deprecated and ignored. Sensor indexes are kept in the metadata store.
+         metadata: (bool)
+            only use the stored sensor metadata. The PurpleAir API is not queried.
 
       Returns:
          (List, List, str)
    '''
-   metadata_path = config.root_path + os.path.sep + config.metadata_folder 
-   metadata_filename = filename + " " + ' '.join(bbox) + ".txt"
-   metadata_full_path = metadata_path + os.path.sep + metadata_filename
-   root_url = "https://api.purpleair.com/v1/sensors"
-   params = {
-      'fields': "name,latitude,longitude,primary_id_a,primary_key_a,primary_id_b,primary_key_b,location_type",
-      'nwlng': bbox[0],
-      'selat': bbox[1],
-      'selng': bbox[2],
-      'nwlat': bbox[3]
-      }
-   url_template = root_url + "?fields={fields}&nwlng={nwlng}&nwlat={nwlat}&selng={selng}&selat={selat}"
-   url = url_template.format(**params)
+   store = get_metadata_store()
    try:
-      sensor_ids = []
-      header = {"X-API-Key":config.purpleair_read_key}
-      #response will be a list of lists in the format 
-      # [[sensor_id_1, sensor_name_1, location_type], [sensor_id_2, sensor_name_2, location_type]]
-      response = requests.get(url, headers=header)
-      if response.status_code == 200:
-         sensors_data = json.loads(response.text)
-         for sensor_list in sensors_data['data']:
-            # if sensor_location is outside (0)
-            if sensor_list[8] == 0:
-               sensor_ids.append(sensor_list)
+      covered = store.covers(bbox)
+      if metadata or covered:
+         if not covered:
+            print("warning. bounding box is not fully covered by the stored sensor metadata.")
+         sensor_ids = store.sensors(bbox)
          print(" ")
-         print(len(sensor_ids))
+         print(f"{len(sensor_ids)} sensors from stored metadata")
          print(" ")
-         #print(sensor_ids)
-         #print(" ")
-         with open(metadata_full_path, 'w') as f:
-            f.write(str(sensor_ids))
          return sensor_ids
-      else:
-         print("error no 200 response.")
-   except Exception as e:
-      print(e)
+      root_url = "https://api.purpleair.com/v1/sensors"
+      params = {
+         'fields': "name,latitude,longitude,primary_id_a,primary_key_a,primary_id_b,primary_key_b,location_type",
+         'nwlng': bbox[0],
+         'selat': bbox[1],
+         'selng': bbox[2],
+         'nwlat': bbox[3]
+         }
+      url_template = root_url + "?fields={fields}&nwlng={nwlng}&nwlat={nwlat}&selng={selng}&selat={selat}"
+      url = url_template.format(**params)
+      try:
+         sensor_ids = []
+         header = {"X-API-Key":config.purpleair_read_key}
+         #response will be a list of lists in the format 
+         # [[sensor_id_1, sensor_name_1, location_type], [sensor_id_2, sensor_name_2, location_type]]
+         response = requests.get(url, headers=header)
+         if response.status_code == 200:
+            sensors_data = json.loads(response.text)
+            store.add(bbox, sensors_data['data'])
+            for sensor_list in sensors_data['data']:
+               # if sensor_location is outside (0)
+               if sensor_list[8] == 0:
+                  sensor_ids.append(sensor_list)
+            print(" ")
+            print(len(sensor_ids))
+            print(" ")
+            return sensor_ids
+         else:
+            print("error no 200 response.")
+      except Exception as e:
+         print(e)
+   finally:
+      store.close()
 
 
 def date_range(start_time, end_time, intv):
@@ -113,6 +146,61 @@ def date_range(start_time, end_time, intv):
    yield end_time.strftime("%Y%m%d")
 
 
+def chunk_dates(start_time, end_time, interval):
+   '''Splits a date range into the chunk boundaries for the ThingSpeak requests of one sensor.
+
+      Args:
+         start_time: (datetime)
+         end_time: (datetime)
+         interval: (int)
+
+      Returns:
+         (list, str) chunk boundary dates. chunk t runs from element t to element t+1.
+   '''
+   delta = end_time - start_time
+   rows = delta.days * 24 * 60 / int(interval)
+   intv = int(math.ceil(rows / 7800))
+   if intv < 1:
+      intv = 1
+   return list(date_range(start_time, end_time, intv))
+
+
+# AQI breakpoints, one row per category
+#   [Ilow, Ihigh, Clow, Chigh]
+# Concentrations beyond the hazardous range are calculated with the hazardous breakpoints.
+PM25_AQI_BREAKPOINTS = np.array([
+   [0, 50, 0, 12],             #good
+   [51, 100, 12.1, 35.4],      #moderate
+   [101, 150, 35.5, 55.4],     #sensitive
+   [151, 200, 55.5, 150.4],    #unhealthy
+   [201, 300, 150.5, 250.4],   #very
+   [301, 500, 250.5, 500.4]    #hazardous
+   ])
+
+
+def calc_aqi_array(PM2_5):
+   '''Calculates AQI values for an array of raw particle density values.
+
+      Args:
+         PM2_5: (array-like, float)
+            Raw particle density measurements
+      
+      Returns:
+         Calculated AQI values: (numpy array, int)
+      
+      Notes:
+         Vectorized equivalent of calc_aqi(). Missing, non-numeric, infinite and negative values are
+         treated as 0 and the values are truncated to one decimal place before the breakpoint lookup.
+   '''
+   PM2_5 = np.array(pd.to_numeric(PM2_5, errors='coerce'), dtype=float, ndmin=1)
+   PM2_5[~np.isfinite(PM2_5) | (PM2_5 < 0)] = 0
+   PM2_5 = np.trunc(PM2_5 * 10) / 10.0
+   category = np.searchsorted(PM25_AQI_BREAKPOINTS[:, 2], PM2_5, side='right') - 1
+   Ilow, Ihigh, Clow, Chigh = PM25_AQI_BREAKPOINTS[category].T
+   Ipm25 = np.rint((Ihigh - Ilow) / (Chigh - Clow) * (PM2_5 - Clow) + Ilow)
+   return Ipm25.astype(int)
+
+
 def calc_aqi(PM2_5):
    '''Calculates AQI value from provided raw particle density value.
 
@@ -128,58 +216,325 @@ def calc_aqi(PM2_5):
          "AQI". "AQI" in quotes as this is not an official methodology. AQI is 
          24 hour midnight-midnight average. May change to NowCast or other
          methodology in the future.
+
+         Scalar wrapper around calc_aqi_array(). Use calc_aqi_array() for whole columns.
    '''
-   # Truncate to one decimal place.
-   # There shouldn't be any NaN values as they have been filtered out but just in case.
-   try:
-      if (PM2_5 < 0) or math.isnan(PM2_5):
-         PM2_5 = 0
-   except TypeError as e:
-         PM2_5 = 0
-   PM2_5 = int(PM2_5 * 10) / 10.0
-   #AQI breakpoints [0,    1,     2,    3    ]
-   #                [Ilow, Ihigh, Clow, Chigh]
-   pm25_aqi = {
-      'good': [0, 50, 0, 12],
-      'moderate': [51, 100, 12.1, 35.4],
-      'sensitive': [101, 150, 35.5, 55.4],
-      'unhealthy': [151, 200, 55.5, 150.4],
-      'very': [201, 300, 150.5, 250.4],
-      'hazardous': [301, 500, 250.5, 500.4],
-      'beyond_aqi': [301, 500, 250.5, 500.4]
-      }
+   return int(calc_aqi_array([PM2_5])[0])
+
+
+MAPPING = {
+   'created_at': 'created_at',
+   'entry_id': 'entry_id',
+   'field1': 'PM1.0_CF1_ug/m3',
+   'field2': 'PM2.5_CF1_ug/m3',
+   'field3': 'PM10.0_CF1_ug/m3',
+   'field4': 'UptimeMinutes',
+   'field5': 'RSSI_dbm',
+   'field6': 'Temperature_F',
+   'field7': 'Humidity_%',
+   'field8': 'PM2.5_ATM_ug/m3'
+   }
+
+
+# ThingSpeak response schema after renaming
+# entry_id is nullable. ThingSpeak leaves it empty in averaged feeds.
+TS_DTYPES = {
+   'entry_id': 'Int64',
+   'PM1.0_CF1_ug/m3': 'float64',
+   'PM2.5_CF1_ug/m3': 'float64',
+   'PM10.0_CF1_ug/m3': 'float64',
+   'UptimeMinutes': 'float64',
+   'RSSI_dbm': 'float64',
+   'Temperature_F': 'float64',
+   'Humidity_%': 'float64',
+   'PM2.5_ATM_ug/m3': 'float64'
+   }
+# ThingSpeak returns created_at as "YYYY-MM-DD HH:MM:SS UTC" when no timezone is requested
+TS_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Columns not used for plotting. Dropped at parse time with --drop.
+DROP_COLUMNS = ('entry_id', 'UptimeMinutes', 'RSSI_dbm')
+
+
+def parse_ts_csv(content, drop_columns=()):
+   '''Parses a ThingSpeak feeds.csv response. The byte buffer is read directly with a fixed schema, the
+      fields are named at parse time and created_at is parsed with the known ThingSpeak format.
+
+      Args:
+         content: (bytes)
+            raw ThingSpeak response
+         drop_columns: (list, str)
+            renamed columns to leave out, see DROP_COLUMNS
+
+      Returns:
+         (Pandas dataframe)
+   '''
+   end = content.find(b'\n')
+   header = content[:end if end >= 0 else len(content)].decode('utf-8').strip().split(',')
+   names = [MAPPING.get(name, name) for name in header]
+   usecols = [name for name in names if name not in drop_columns]
+   dtype = {name: TS_DTYPES[name] for name in usecols if name in TS_DTYPES}
    try:
-      if (0.0 <= PM2_5 <= 12.0):
-         aqi_cat = 'good'
-      elif (12.1 <= PM2_5 <= 35.4):
-         aqi_cat = 'moderate'
-      elif (35.5 <= PM2_5 <= 55.4):
-         aqi_cat = 'sensitive'
-      elif (55.5 <= PM2_5 <= 150.4):
-         aqi_cat = 'unhealthy'
-      elif (150.5 <= PM2_5 <= 250.4):
-         aqi_cat = 'very'
-      elif (250.5 <= PM2_5 <= 500.4):
-         aqi_cat = 'hazardous'
-      elif (PM2_5 >= 500.5):
-         aqi_cat = 'beyond_aqi'
+      df = pd.read_csv(io.BytesIO(content), header=0, names=names, usecols=usecols, dtype=dtype)
+   except ValueError:
+      # A field that doesn't match the schema. Fall back to type inference for this response.
+      df = pd.read_csv(io.BytesIO(content), header=0, names=names, usecols=usecols)
+      for name in dtype:
+         df[name] = pd.to_numeric(df[name], errors='coerce').astype(dtype[name])
+   created_at = df['created_at']
+   if len(created_at) and not created_at.iloc[0].endswith(" UTC"):
+      df['created_at'] = pd.to_datetime(created_at, utc=True)
+   else:
+      # Slicing off the suffix lets pandas use its fast fixed format parser rather than strptime.
+      df['created_at'] = pd.to_datetime(created_at.str.slice(0, 19), format=TS_DATE_FORMAT, utc=True)
+   return df
+
+
+def process_channel(df):
+   '''Drops empty readings and adds the calculated AQI.
+
+      Args:
+         df: (Pandas dataframe)
+            parsed ThingSpeak readings for one channel, see parse_ts_csv()
+
+      Returns:
+         (Pandas dataframe)
+   '''
+   df = df[df['PM2.5_ATM_ug/m3'].notnull()].copy()
+
+   # Calculate AQI
+   df['Ipm25'] = calc_aqi_array(df['PM2.5_ATM_ug/m3'])
+   #Need to improve data quality tests in the future
+   df = df[df['Ipm25'] <= 1200]
+   return df
+
+
+class ChunkAccumulator:
+   '''Collects the parsed ThingSpeak responses for each channel. Each channel frame is built with a single
+      concat at the end rather than copying the growing frame for every response. Chunks carry an integer
+      sensor_code rather than the sensor name and coordinates, which are joined back from the sensors table.
+
+      Args:
+         sensors: (Pandas dataframe)
+            sensor dimension table, see pa_compact.sensor_table()
+         stream_paths: (dict, str)
+            optional csv path for each channel. Chunks for these channels are processed and appended to
+            the file as each one is added, in request order, instead of being held in memory.
+         compact: (bool)
+            return the compact sensors and readings tables instead of the wide frames
+   '''
+   def __init__(self, sensors, stream_paths=None, compact=False):
+      self.sensors = sensors
+      self.compact = compact
+      self.chunks = defaultdict(list)
+      self.stream_paths = stream_paths or {}
+      self.streamed_rows = defaultdict(int)
+      for path in self.stream_paths.values():
+         if os.path.exists(path):
+            os.remove(path)
+
+   def add(self, key, df):
+      '''Adds one raw chunk for channel key.'''
+      if key in self.stream_paths:
+         df = expand_readings(self.sensors, process_channel(df))
+         path = self.stream_paths[key]
+         df.to_csv(path, mode='a', index=False, header=not os.path.exists(path))
+         self.streamed_rows[key] += len(df)
       else:
-         print(" ")
-         print(f"PM2_5: {PM2_5}")
-      Ihigh = pm25_aqi.get(aqi_cat)[1]
-      Ilow = pm25_aqi.get(aqi_cat)[0]
-      Chigh = pm25_aqi.get(aqi_cat)[3]
-      Clow = pm25_aqi.get(aqi_cat)[2]
-      Ipm25 = int(round(
-         ((Ihigh - Ilow) / (Chigh - Clow) * (PM2_5 - Clow) + Ilow)
-         ))
-      return Ipm25
-   except Exception as e:
-      pass
-      print(f"error in calc_aqi() function: {e}")
- 
+         self.chunks[key].append(df)
+
+   def frames(self):
+      '''Returns the processed frame for each channel that was not streamed to disk. In compact mode the
+         channel frames are readings tables and the sensors table is returned under the 'sensors' key. The
+         readings keep their full float64 precision. See pa_compact.compact_dtypes() to narrow them.
+
+         Returns:
+            (dict, Pandas dataframe)
+      '''
+      dfs = {}
+      for key in list(self.chunks):
+         readings = process_channel(pd.concat(self.chunks.pop(key), ignore_index=True))
+         if self.compact:
+            dfs[key] = readings.astype({'sensor_code': np.int32})
+         else:
+            dfs[key] = expand_readings(self.sensors, readings)
+      if self.compact:
+         dfs['sensors'] = self.sensors
+      for key, rows in self.streamed_rows.items():
+         print(f"{rows} rows written to {self.stream_paths[key]}")
+      return dfs
+
+
+class TokenBucket:
+   '''Token bucket rate limiter shared by the ThingSpeak fetch workers.
+
+      Args:
+         rate: (float)
+            sustained requests per second
+         capacity: (int)
+            maximum burst of requests
+   '''
+   def __init__(self, rate, capacity=1):
+      self.rate = float(rate)
+      self.capacity = capacity
+      self.tokens = float(capacity)
+      self.timestamp = monotonic()
+      self.lock = threading.Lock()
+
+   def acquire(self):
+      '''Blocks until a token is available then consumes it.'''
+      while True:
+         with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            if self.tokens >= 1:
+               self.tokens -= 1
+               return
+            wait = (1 - self.tokens) / self.rate
+         sleep(wait)
 
-def get_ts_data(sensor_ids, start_time, end_time, interval, channel):
+
+_thread_local = threading.local()
+
+
+def get_session():
+   '''Returns a requests session for the calling thread. Sessions are not shared between fetch workers.
+
+      Returns:
+         (requests.Session)
+   '''
+   session = getattr(_thread_local, 'session', None)
+   if session is None:
+      session = requests.Session()
+      retry = Retry(connect=3, backoff_factor=0.5)
+      adapter = HTTPAdapter(max_retries=retry)
+      session.mount('http://', adapter)
+      session.mount('https://', adapter)
+      _thread_local.session = session
+   return session
+
+
+def is_feeds_csv(content):
+   '''Returns whether a response body is a ThingSpeak feeds csv rather than an error such as -1 or an html
+      page. Only feeds csv bodies are cached or checkpointed.'''
+   return content is not None and content.lstrip().startswith(b'created_at')
+
+
+def fetch_url(url, limiter=None, retries=3):
+   '''Gets a single ThingSpeak url. Failed attempts are reported and retried.
+
+      Args:
+         url: (str)
+         limiter: (TokenBucket)
+            optional rate limiter
+         retries: (int)
+            number of attempts before giving up
+
+      Returns:
+         (bytes) response content or None if every attempt failed
+   '''
+   for attempt in range(1, retries + 1):
+      if limiter is not None:
+         limiter.acquire()
+      try:
+         response = get_session().get(url, timeout=60)
+         if response.status_code == 200 and is_feeds_csv(response.content):
+            return response.content
+         elif response.status_code == 200:
+            error = f"not a feeds csv: {response.content[:40]!r}"
+         else:
+            error = f"status code {response.status_code}"
+      except requests.exceptions.RequestException as e:
+         error = e
+      print(f"request failed ({error}) attempt {attempt} of {retries}: {url}")
+      if attempt < retries:
+         sleep(0.5 * 2 ** (attempt - 1))
+   return None
+
+
+def fetch_all(urls, workers=1, rate=None, retries=3, cache=None, cache_keys=None, job=None, unit_ids=None, labels=None):
+   '''Gets a list of urls either serially or with a pool of worker threads. Responses are yielded in the order
+      of urls as they complete, so each can be processed and released before the rest arrive. At most 4
+      requests per worker are started ahead of the response being consumed.
+
+      Args:
+         urls: (list, str)
+         workers: (int)
+            number of concurrent requests
+         rate: (float)
+            maximum requests per second for all workers combined. None or 0 for no limit.
+         retries: (int)
+         cache: (pa_cache.ResponseCache)
+            optional response cache
+         cache_keys: (list, tuple)
+            cache key for each url
+         job: (pa_job.JobManifest)
+            optional job manifest. Completed units are written to disk as they arrive.
+         unit_ids: (list, str)
+            job unit id for each url
+         labels: (list, str)
+            optional progress label for each url, printed when its request completes
+
+      Returns:
+         (iterator, bytes) response content in the same order as urls. None for failed requests.
+   '''
+   limiter = TokenBucket(rate, capacity=max(1, workers)) if rate else None
+
+   def fetch(url, cache_key, unit_id, label):
+      content = fetch_unit(url, cache_key, unit_id)
+      if label is not None:
+         # One write per line so lines from concurrent workers don't interleave.
+         print(f"{label} : {url}\n", end='')
+      return content
+
+   def fetch_unit(url, cache_key, unit_id):
+      # Bodies stored by earlier versions are checked too, so a bad one is downloaded again.
+      if job is not None:
+         content = job.get(unit_id, is_feeds_csv)
+         if content is not None:
+            return content
+      content = None
+      if cache is not None:
+         content = cache.get(cache_key)
+      if not is_feeds_csv(content):
+         content = fetch_url(url, limiter, retries)
+         if cache is not None and content is not None:
+            cache.put(cache_key, content)
+      if job is not None:
+         if content is not None:
+            job.put(unit_id, content)
+         else:
+            job.fail(unit_id)
+      return content
+
+   if cache_keys is None:
+      cache_keys = [None] * len(urls)
+      cache = None
+   if unit_ids is None:
+      unit_ids = [None] * len(urls)
+      job = None
+   if labels is None:
+      labels = [None] * len(urls)
+   requests_iter = zip(urls, cache_keys, unit_ids, labels)
+   if workers <= 1:
+      for request in requests_iter:
+         yield fetch(*request)
+      return
+   executor = ThreadPoolExecutor(max_workers=workers)
+   try:
+      pending = deque(executor.submit(fetch, *request) for request in islice(requests_iter, workers * 4))
+      while pending:
+         content = pending.popleft().result()
+         request = next(requests_iter, None)
+         if request is not None:
+            pending.append(executor.submit(fetch, *request))
+         yield content
+   finally:
+      # Don't start queued requests after an interrupt. Completed units are already on disk.
+      executor.shutdown(wait=True, cancel_futures=True)
+
+
+def get_ts_data(sensor_ids, start_time, end_time, interval, channel, workers=1, rate=None, retries=3, stream_paths=None, cache=None, job=None, compact=False, drop_columns=(), since=None):
    '''Gets sensor readings from the ThingSpeak API.
 
       Args:
@@ -187,33 +542,53 @@ def get_ts_data(sensor_ids, start_time, end_time, interval, channel):
          start_time: (datetime)
          end_time: (datetime)
          interval: (int)
+         channel: (str)
+         workers: (int)
+            number of concurrent ThingSpeak requests
+         rate: (float)
+            maximum ThingSpeak requests per second. None or 0 for no limit.
+         retries: (int)
+            attempts per request
+         stream_paths: (dict, str)
+            optional csv path for each channel. Streamed channels are appended to disk as they
+            arrive and are not returned.
+         cache: (pa_cache.ResponseCache)
+            optional cache of completed chunk responses
+         job: (pa_job.JobManifest)
+            optional job manifest for checkpointed, resumable downloads
+         compact: (bool)
+            return the compact pa_compact sensors and readings tables instead of the wide frames. The
+            readings keep the float64 precision of the wide frames.
+         drop_columns: (list, str)
+            columns to leave out at parse time, see DROP_COLUMNS
+         since: (dict, datetime)
+            optional latest stored reading time for each sensor, keyed by sensor_key(). Only readings
+            after it are requested. Sensors not in since get the full start_time to end_time range.
 
       Returns:
-         (Pandas dataframe)
+         (dict, Pandas dataframe)
    '''
-   import sys
-   session = requests.Session()
-   retry = Retry(connect=3, backoff_factor=0.5)
-   adapter = HTTPAdapter(max_retries=retry)
-   session.mount('http://', adapter)
-   session.mount('https://', adapter)
    url_params = defaultdict(dict)
-   df_a = None
-   df_b = None
-   delta = end_time - start_time
-   rows = delta.days * 24 * 60 / int(interval)
-   intv = int(math.ceil(rows / 7800))
-   if intv < 1:
-      intv = 1
-   data_range = list(date_range(start_time, end_time, intv)) 
-   num_sensors = len(sensor_ids)
+   # In update mode each sensor already stored only needs the range since its latest reading.
+   # Sensors that are new to the bbox get the full range.
+   cutoffs = []
+   sensor_ranges = []
+   for sensor in sensor_ids:
+      cutoff = since.get(sensor_key(sensor[1], sensor[3], sensor[2])) if since is not None else None
+      sensor_start = start_time
+      if cutoff is not None:
+         sensor_start = pd.Timestamp(cutoff).tz_convert(None).to_pydatetime()
+      cutoffs.append(cutoff)
+      sensor_ranges.append(chunk_dates(sensor_start, end_time, interval) if sensor_start <= end_time else [])
+   num_requests = sum(max(len(data_range) - 1, 0) for data_range in sensor_ranges)
    request_num = 0
    root_url = 'https://api.thingspeak.com/channels/{ts_channel}/feeds.csv?api_key={api_key}&start={start}%2000:00:00&end={end}%2023:59:59&average={average}'
-   for idx, sensor in enumerate(sensor_ids):
-      sensor_name = sensor[1]
-      lat = sensor[2]
-      lon = sensor[3]
-      for t in range(0, intv):
+   # Build the full list of requests first so they can be fetched concurrently and
+   # then assembled in the same order as a serial run.
+   requests_list = []
+   for sensor_code, sensor in enumerate(sensor_ids):
+      data_range = sensor_ranges[sensor_code]
+      for t in range(0, len(data_range) - 1):
          request_num += 1
          start_time = data_range[t]
          end_time = data_range[t+1]
@@ -231,91 +606,103 @@ def get_ts_data(sensor_ids, start_time, end_time, interval, channel):
             url_params['b']['average'] = interval
          for key, params in url_params.items():
             url = root_url.format(**params)
-            print(f"{request_num}{key} of {num_sensors * intv} : {url}")
-            if key == 'a':
-               if df_a is None:
-                  response = session.get(url)
-                  url_data = response.content
-                  df_a = pd.read_csv(io.StringIO(url_data.decode('utf-8')))
-                  df_a.insert(0, 'Sensor', sensor_name)
-                  df_a.insert(0, 'Lat', lat)
-                  df_a.insert(0, 'Lon', lon)
-               elif df_a is not None:
-                  response = session.get(url)
-                  url_data = response.content
-                  df_a_s = pd.read_csv(io.StringIO(url_data.decode('utf-8')))
-                  df_a_s.insert(0, 'Sensor', sensor_name)
-                  df_a_s.insert(0, 'Lat', lat)
-                  df_a_s.insert(0, 'Lon', lon)
-                  df_a = pd.concat([df_a, df_a_s])
-            if key == 'b':
-               if df_b is None:
-                  response = session.get(url)
-                  url_data = response.content
-                  df_b = pd.read_csv(io.StringIO(url_data.decode('utf-8')))
-                  df_b.insert(0, 'Sensor', sensor_name)
-                  df_b.insert(0, 'Lat', lat)
-                  df_b.insert(0, 'Lon', lon)
-               elif df_b is not None:
-                  response = session.get(url)
-                  url_data = response.content
-                  df_b_s = pd.read_csv(io.StringIO(url_data.decode('utf-8')))
-                  df_b_s.insert(0, 'Sensor', sensor_name)
-                  df_b_s.insert(0, 'Lat', lat)
-                  df_b_s.insert(0, 'Lon', lon)
-                  df_b = pd.concat([df_b, df_b_s])
-   mapping = {
-      'created_at': 'created_at',
-      'entry_id': 'entry_id',
-      'field1': 'PM1.0_CF1_ug/m3',
-      'field2': 'PM2.5_CF1_ug/m3',
-      'field3': 'PM10.0_CF1_ug/m3',
-      'field4': 'UptimeMinutes',
-      'field5': 'RSSI_dbm',
-      'field6': 'Temperature_F',
-      'field7': 'Humidity_%',
-      'field8': 'PM2.5_ATM_ug/m3'
-      }
-   if df_a is not None:
-      df_a = df_a.rename(columns=mapping)
-      df_a['created_at'] = pd.to_datetime(df_a['created_at'])
-      df_a = df_a[df_a['PM2.5_ATM_ug/m3'].notnull()]
-
-      # Calculate AQI
-      df_AQI = df_a[['created_at', 'PM2.5_ATM_ug/m3']].copy()
-      df_AQI['created_at'] = pd.to_datetime(df_AQI['created_at'])
-      df_AQI['Ipm25'] = df_AQI.apply(
-            lambda x: calc_aqi(x['PM2.5_ATM_ug/m3']),
-            axis=1
-            )
-      df_a['Ipm25'] = df_AQI['Ipm25']
-      #Need to improve data quality tests in the future
-      df_a = df_a[df_a['Ipm25'] <= 1200]
-   if df_b is not None:
-      df_b = df_b.rename(columns=mapping)
-      df_b['created_at'] = pd.to_datetime(df_b['created_at'])
-      df_b = df_b[df_b['PM2.5_ATM_ug/m3'].notnull()]
-
-      # Calculate AQI
-      df_AQI = df_b[['created_at', 'PM2.5_ATM_ug/m3']].copy()
-      df_AQI['created_at'] = pd.to_datetime(df_AQI['created_at'])
-      df_AQI['Ipm25'] = df_AQI.apply(
-            lambda x: calc_aqi(x['PM2.5_ATM_ug/m3']),
-            axis=1
-            )
-      df_b['Ipm25'] = df_AQI['Ipm25']
-      #Need to improve data quality tests in the future
-      df_b = df_b[df_b['Ipm25'] <= 1200]
-
-   dfs = {}
-   if df_a is not None:
-      dfs['a'] = df_a
-   if df_b is not None:
-      dfs['b'] = df_b
-   return dfs
+            cache_key = (params['ts_channel'], start_time, end_time, interval)
+            unit_id = JobManifest.unit_id(key, sensor, start_time, end_time)
+            requests_list.append((key, sensor_code, url, cache_key, unit_id, f"{request_num}{key} of {num_requests}"))
+   # Streamed channels are appended to disk as each response arrives in request order, so only the
+   # responses fetched ahead by the workers are held in memory.
+   accumulator = ChunkAccumulator(sensor_table(sensor_ids), stream_paths, compact)
+   responses = fetch_all(
+      [request[2] for request in requests_list],
+      workers, rate, retries, cache,
+      [request[3] for request in requests_list],
+      job,
+      [request[4] for request in requests_list],
+      [request[5] for request in requests_list]
+      )
+   failed = []
+   for (key, sensor_code, url, cache_key, unit_id, label), url_data in zip(requests_list, responses):
+      if url_data is None:
+         failed.append(url)
+         continue
+      try:
+         df_s = parse_ts_csv(url_data, drop_columns)
+      except (KeyError, ValueError) as e:
+         print(f"response could not be parsed ({e!r}): {url}")
+         failed.append(url)
+         continue
+      if cutoffs[sensor_code] is not None:
+         df_s = df_s[df_s['created_at'] > cutoffs[sensor_code]]
+      df_s.insert(0, 'sensor_code', sensor_code)
+      accumulator.add(key, df_s)
+   if failed:
+      print(" ")
+      print(f"{len(failed)} of {len(requests_list)} requests failed:")
+      for url in failed:
+         print(url)
+   if cache is not None:
+      cache.report()
+   if job is not None:
+      job.close()
+   return accumulator.frames()
+
+
+def sensor_key(name, lon, lat):
+   '''Returns the key of a sensor in update mode. PurpleAir sensor names are not unique, so the name is
+      combined with the sensor location.
 
+      Args:
+         name: (str)
+         lon: (float)
+         lat: (float)
+
+      Returns:
+         (tuple)
+   '''
+   return (str(name), round(float(lon), 6), round(float(lat), 6))
+
+
+def stored_timestamps(data_file_full_path):
+   '''Gets the latest stored reading time of each sensor and the earliest stored reading time in an existing
+      csv file or data store. Only the Sensor, Lon, Lat and created_at columns are read.
+
+      Args:
+         data_file_full_path: (str)
+            csv file or pa_store folder
+
+      Returns:
+         (dict, datetime) latest created_at for each sensor, keyed by sensor_key()
+         (datetime) earliest created_at
+   '''
+   columns = ['Sensor', 'Lon', 'Lat', 'created_at']
+   if os.path.isdir(data_file_full_path):
+      from pa_store import read_store
+      df = read_store(data_file_full_path, columns=columns)
+   else:
+      df = pd.read_csv(data_file_full_path, usecols=columns)
+      df['created_at'] = pd.to_datetime(df['created_at'], utc=True)
+   latest = df.groupby(['Sensor', 'Lon', 'Lat'], observed=True)['created_at'].max()
+   since = {sensor_key(*key): created_at for key, created_at in latest.items()}
+   return since, df['created_at'].min()
+
+
+def append_readings(df, data_file_full_path):
+   '''Appends new readings to an existing csv file or data store without rewriting it.
+
+      Args:
+         df: (Pandas dataframe)
+         data_file_full_path: (str)
+            csv file or pa_store folder
+   '''
+   if os.path.isdir(data_file_full_path):
+      from pa_store import write_store
+      write_store(df, data_file_full_path, append=True)
+   else:
+      columns = pd.read_csv(data_file_full_path, nrows=0).columns
+      df.reindex(columns=columns).to_csv(data_file_full_path, mode='a', index=False, header=False)
 
-def pa_get_df(start_time, end_time, bbox, interval, channel, metadata, filename="indices"):
+
+def pa_get_df(start_time, end_time, bbox, interval, channel, metadata, filename="indices", workers=1, rate=None, stream_paths=None, use_cache=True, job=None, compact=False, drop_columns=(), since=None):
    '''Main entry point. Executes the various functions.
       
       Args:
@@ -323,33 +710,46 @@ def pa_get_df(start_time, end_time, bbox, interval, channel, metadata, filename=
          end_time: (datetime)
          bbox: (list, float)
          intv: (int)
+         metadata: (bool)
+            only use the stored sensor metadata
+         filename: (str)
+            deprecated and ignored. Sensor indexes are kept in the metadata store.
+         workers: (int)
+            number of concurrent ThingSpeak requests
+         rate: (float)
+            maximum ThingSpeak requests per second. None or 0 for no limit.
+         stream_paths: (dict, str)
+            optional csv path for each channel to append readings to as they arrive.
+         use_cache: (bool)
+            serve completed ThingSpeak chunks from the local response cache
+         job: (pa_job.JobManifest)
+            optional job manifest for checkpointed, resumable downloads
+         compact: (bool)
+            return the compact pa_compact sensors and readings tables instead of the wide frames. The
+            readings keep the float64 precision of the wide frames.
+         drop_columns: (list, str)
+            columns to leave out at parse time, see DROP_COLUMNS
+         since: (dict, datetime)
+            optional latest stored reading time for each sensor, keyed by sensor_key(), for update mode
       
       Returns:
-         (Pandas dataframe)
+         (dict, Pandas dataframe)
    '''
-   import sys
-
-   if not metadata:
-      sensor_ids = get_sensor_indexes(bbox, filename)
-   elif metadata:
-      metadata_path = config.root_path + os.path.sep + config.metadata_folder 
-      items = os.listdir(metadata_path)
-      file_list = [name for name in items if name.endswith(".txt")]
-      for n, fileName in enumerate(file_list, 1):
-         sys.stdout.write("[%d] %s\n\r" % (n, fileName))
-      choice = int(input("Select data file[1-%s]: " % n))
-      metadata_full_path = metadata_path + os.path.sep + file_list[choice-1]
-      with open(metadata_full_path, 'r') as f:
-         sensor_ids = ast.literal_eval(f.read())
-   dfs = get_ts_data(sensor_ids, start_time, end_time, interval, channel)
+   sensor_ids = get_sensor_indexes(bbox, metadata=metadata)
+   cache = None
+   if use_cache:
+      cache_path = config.root_path + os.path.sep + getattr(config, 'cache_folder', 'cache')
+      cache = ResponseCache(cache_path, getattr(config, 'cache_size_mb', 2048) * 1024 * 1024)
+   dfs = get_ts_data(sensor_ids, start_time, end_time, interval, channel, workers, rate, stream_paths=stream_paths, cache=cache, job=job, compact=compact, drop_columns=drop_columns, since=since)
    return dfs
 
 
 if __name__ == "__main__":
    import argparse
-   from datetime import datetime
+   from datetime import datetime, timezone
    import os
    import config
+   from pa_store import write_store
 
    root_path = config.root_path + os.path.sep
    data_path = root_path + config.data_folder
@@ -367,7 +767,7 @@ if __name__ == "__main__":
       parser = argparse.ArgumentParser(
       description='get PurpleAir PA-II sensor data from ThingSpeak.',
       prog='pa_get_df',
-      usage='%(prog)s [-b <bbox>], [-o <output>], [-i <interval>], [-s <start>], [-e <end>], [-c <channel>], [-md]',
+      usage='%(prog)s [-b <bbox>], [-o <output>], [-i <interval>], [-s <start>], [-e <end>], [-c <channel>], [-w <workers>], [--rate <rate>], [--stream], [--format <format>], [--ps], [--drop], [-u <file>], [--nocache], [--resume], [-md]',
       formatter_class=argparse.RawDescriptionHelpFormatter,
       )
       g=parser.add_argument_group(title='arguments',
@@ -377,7 +777,17 @@ if __name__ == "__main__":
       -s  --startdate                       optional.  start date. format "YYYY-MM-DD HH:MM:SS" include quotes. 
       -e  --enddate                         optional.  end date. format "YYYY-MM-DD HH:MM:SS" include quotes.
       -c  --channel                         optional.  channel.
-          --md                              optional.  use stored sensor metadata        ''')
+      -w  --workers                         optional.  number of concurrent ThingSpeak requests.
+          --rate                            optional.  maximum ThingSpeak requests per second. 0 for no limit.
+          --stream                          optional.  append readings to the csv file as they arrive.
+          --format                          optional.  output format. csv, parquet or feather.
+          --ps                              optional.  partition parquet or feather output by sensor as well as date.
+          --drop                            optional.  leave out the entry_id, UptimeMinutes and RSSI_dbm columns.
+      -u  --update                          optional.  csv file or data store in the Data folder to update with the readings since
+                                                       its latest reading. new sensors are backfilled from the start date.
+          --nocache                         optional.  do not use the local ThingSpeak response cache.
+          --resume                          optional.  resume an interrupted download with the same arguments.
+          --md                              optional.  only use stored sensor metadata. do not query PurpleAir.        ''')
       g.add_argument('-b', '--bbox',
                      type=float,
                      nargs = 4,
@@ -406,6 +816,41 @@ if __name__ == "__main__":
                      choices = ['a', 'b', 'ab'],
                      dest='channel',
                      help=argparse.SUPPRESS)
+      g.add_argument('-w', '--workers',
+                     type=int,
+                     default = 1,
+                     dest='workers',
+                     help=argparse.SUPPRESS)
+      g.add_argument('--rate',
+                     type=float,
+                     default = 0,
+                     dest='rate',
+                     help=argparse.SUPPRESS)
+      g.add_argument('--stream', action='store_true',
+                     dest='stream',
+                     help=argparse.SUPPRESS)
+      g.add_argument('--format',
+                     type=str,
+                     default = 'csv',
+                     choices = ['csv', 'parquet', 'feather'],
+                     dest='format',
+                     help=argparse.SUPPRESS)
+      g.add_argument('--ps', action='store_true',
+                     dest='partition_sensor',
+                     help=argparse.SUPPRESS)
+      g.add_argument('--drop', action='store_true',
+                     dest='drop',
+                     help=argparse.SUPPRESS)
+      g.add_argument('-u', '--update',
+                     type=str,
+                     dest='update',
+                     help=argparse.SUPPRESS)
+      g.add_argument('--nocache', action='store_false',
+                     dest='use_cache',
+                     help=argparse.SUPPRESS)
+      g.add_argument('--resume', action='store_true',
+                     dest='resume',
+                     help=argparse.SUPPRESS)
       g.add_argument('--md', action='store_true',
                      dest='metadata',
                      help=argparse.SUPPRESS)
@@ -416,7 +861,57 @@ if __name__ == "__main__":
 
    bbox = args.bbox
    bbox_pa = (str(bbox[0]), str(bbox[1]), str(bbox[2]), str(bbox[3]))
-   dfs = pa_get_df(args.startdate, args.enddate, bbox_pa, args.interval, args.channel, args.metadata, args.filename)
+   since = None
+   if args.update is not None:
+      if args.channel == 'ab':
+         print("error. --update takes a single channel, a or b. exiting")
+         exit()
+      update_path = args.update
+      if not os.path.exists(update_path):
+         update_path = data_path + os.path.sep + args.update
+      since, earliest = stored_timestamps(update_path)
+      # The update job is named after the file it updates, not the dates, so --resume finds it.
+      job_path = os.path.splitext(update_path.rstrip(os.path.sep))[0] + "_update_job"
+      if args.enddate is None:
+         stored_job = os.path.join(job_path, 'job.json')
+         if args.resume and os.path.exists(stored_job):
+            # A resumed update finishes the date range of the interrupted run.
+            with open(stored_job, 'r') as f:
+               args.enddate = datetime.strptime(json.load(f)['end'], "%Y-%m-%d %H:%M:%S")
+         else:
+            args.enddate = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+      if args.startdate is None:
+         # Sensors new to the bounding box are backfilled from the earliest stored reading.
+         args.startdate = earliest.tz_convert(None).to_pydatetime()
+      args.stream = False
+   data_file_prefix = data_path + os.path.sep + args.filename + "_" + args.startdate.strftime("%Y%m%d") + "_" + args.enddate.strftime("%Y%m%d") + "_"
+   stream_paths = None
+   if args.stream and args.format == 'csv':
+      stream_paths = {key: data_file_prefix + key + ".csv" for key in args.channel}
+   job_params = {
+      'bbox': bbox_pa,
+      'start': str(args.startdate),
+      'end': str(args.enddate),
+      'interval': args.interval,
+      'channel': args.channel,
+      'update': args.update
+      }
+   job = JobManifest(job_path if args.update is not None else data_file_prefix + "job", job_params, args.resume)
+   dfs = pa_get_df(args.startdate, args.enddate, bbox_pa, args.interval, args.channel, args.metadata, args.filename, args.workers, args.rate, stream_paths, args.use_cache, job,
+      drop_columns=DROP_COLUMNS if args.drop else (), since=since)
    for key, df in dfs.items():
-      data_file_full_path = data_path + os.path.sep + args.filename + "_" + args.startdate.strftime("%Y%m%d") + "_" + args.enddate.strftime("%Y%m%d") + "_" + key + ".csv"
-      df.to_csv(data_file_full_path, index=False, header=True)
\ No newline at end of file
+      if args.update is not None and job.failed:
+         # Appending part of the update would move the stored latest readings past the missing ranges.
+         print(f"{len(df)} readings not appended to {update_path} because requests failed.")
+      elif args.update is not None:
+         append_readings(df, update_path)
+         print(f"{len(df)} readings appended to {update_path}")
+      elif args.format == 'csv':
+         data_file_full_path = data_file_prefix + key + ".csv"
+         df.to_csv(data_file_full_path, index=False, header=True)
+      else:
+         write_store(df, data_file_prefix + key + "." + args.format, args.partition_sensor)
+   if job.failed == 0:
+      job.remove()
+   else:
+      print("some requests failed. run again with --resume to retry them.")
\ No newline at end of file
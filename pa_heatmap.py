@@ -0,0 +1,98 @@
+'''Inverse distance weighted surface of sensor readings over a pixel grid.
+
+   The sensors do not move between frames, so the weights of the sensors for every grid cell are computed
+   once. Each cell keeps only its k nearest sensors, the truncated form of a sparse cells x sensors weight
+   matrix with k entries per row. A frame's surface is then one weighted sum over the sensor values. Sensors
+   without a reading in the frame are left out of each sum and the remaining weights renormalized.
+'''
+
+import numpy as np
+
+
+class IDWGrid:
+   '''Inverse distance weights from the sensors to the cells of a grid covering the plot extent.
+
+      Args:
+         lon: (numpy array)
+            sensor longitudes, indexed by sensor_code
+         lat: (numpy array)
+            sensor latitudes, indexed by sensor_code
+         bbox: (list, float)
+            plot extent in the format left right bottom top
+         shape: (int, int)
+            grid rows, columns. row 0 is the top (north) edge.
+         k: (int)
+            number of nearest sensors weighted in each cell
+         power: (float)
+            distance exponent
+         chunk: (int)
+            number of cells whose distances are computed at once
+   '''
+   def __init__(self, lon, lat, bbox, shape, k=8, power=2, chunk=4096):
+      lon = np.asarray(lon, dtype=np.float64)
+      lat = np.asarray(lat, dtype=np.float64)
+      self.shape = tuple(shape)
+      self.sensors = len(lon)
+      rows, columns = self.shape
+      # Distances in degrees of latitude, longitude scaled to the middle of the extent.
+      scale = np.cos(np.radians((bbox[2] + bbox[3]) / 2))
+      cell_x = (bbox[0] + (np.arange(columns) + 0.5) * (bbox[1] - bbox[0]) / columns) * scale
+      cell_y = bbox[3] - (np.arange(rows) + 0.5) * (bbox[3] - bbox[2]) / rows
+      cell_x, cell_y = [a.ravel() for a in np.meshgrid(cell_x, cell_y)]
+      sensor_x, sensor_y = lon * scale, lat
+      k = min(k, self.sensors)
+      cells = rows * columns
+      self.index = np.empty((cells, k), dtype=np.int32)
+      self.weights = np.empty((cells, k), dtype=np.float32)
+      # Half a cell keeps sensors sitting on a cell center from getting an infinite weight.
+      floor = ((bbox[1] - bbox[0]) * scale / columns / 2) ** 2
+      for start in range(0, cells, chunk):
+         stop = min(cells, start + chunk)
+         d2 = (cell_x[start:stop, None] - sensor_x[None, :]) ** 2 + (cell_y[start:stop, None] - sensor_y[None, :]) ** 2
+         nearest = np.argpartition(d2, k - 1, axis=1)[:, :k] if k < self.sensors else np.broadcast_to(np.arange(k), d2.shape)
+         d2 = np.maximum(np.take_along_axis(d2, nearest, axis=1), floor)
+         self.index[start:stop] = nearest
+         self.weights[start:stop] = d2 ** (-power / 2)
+
+   def sensor_values(self, codes, values):
+      '''Returns the mean reading of each sensor, NaN for sensors without a reading.
+
+         Args:
+            codes: (numpy array)
+               sensor_code of each reading
+            values: (numpy array)
+
+         Returns:
+            (numpy array)
+      '''
+      codes = np.asarray(codes, dtype=np.intp)
+      values = np.asarray(values, dtype=np.float64)
+      keep = ~np.isnan(values)
+      counts = np.bincount(codes[keep], minlength=self.sensors)
+      sums = np.bincount(codes[keep], weights=values[keep], minlength=self.sensors)
+      with np.errstate(invalid='ignore', divide='ignore'):
+         return (sums / counts).astype(np.float32)
+
+   def surface(self, sensor_values):
+      '''Interpolates the sensor values over the grid. Cells whose k nearest sensors all have no reading are
+         NaN.
+
+         Args:
+            sensor_values: (numpy array)
+               value of each sensor indexed by sensor_code, NaN for missing
+
+         Returns:
+            (numpy array) rows x columns
+      '''
+      values = np.asarray(sensor_values, dtype=np.float32)[self.index]
+      present = ~np.isnan(values)
+      weights = np.where(present, self.weights, 0)
+      total = weights.sum(axis=1)
+      with np.errstate(invalid='ignore', divide='ignore'):
+         surface = (weights * np.where(present, values, 0)).sum(axis=1) / total
+      surface[total == 0] = np.nan
+      return surface.reshape(self.shape)
+
+   def frame_surface(self, df, column='PM2.5_ATM_ug/m3'):
+      '''Returns the surface of the readings in a frame with sensor_code and value columns.'''
+      return self.surface(self.sensor_values(df['sensor_code'].to_numpy(), df[column].to_numpy()))
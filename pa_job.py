@@ -0,0 +1,123 @@
+'''Checkpointed, resumable ThingSpeak bulk downloads.
+
+   A bulk download is broken into units, one per sensor, date chunk and channel. Each completed unit is written
+   to the job folder as it arrives and its id is appended to the job's manifest file. If a run stops partway
+   through, running again with --resume skips the completed units and assembles the final frame from the
+   stored pieces.
+
+   Job folder layout:
+      job.json       parameters of the download. A resumed run must use the same parameters.
+      manifest.txt   ids of the completed units, one per line.
+      units/         raw ThingSpeak csv response for each completed unit.
+'''
+
+import os
+import json
+import shutil
+import threading
+
+
+class JobManifest:
+   '''Records which units of a bulk download are complete.
+
+      Args:
+         job_path: (str)
+            folder for the job manifest and completed units
+         params: (dict)
+            parameters identifying the download
+         resume: (bool)
+            continue an existing job. Otherwise any existing job in job_path is discarded.
+   '''
+   def __init__(self, job_path, params, resume=False):
+      self.job_path = job_path
+      self.units_path = os.path.join(job_path, 'units')
+      self.manifest_path = os.path.join(job_path, 'manifest.txt')
+      # Compared as stored in job.json, where tuples become lists.
+      self.params = params = json.loads(json.dumps(params))
+      self.lock = threading.Lock()
+      self.done = set()
+      self.resumed = 0
+      self.failed = 0
+      params_path = os.path.join(job_path, 'job.json')
+      if resume and os.path.exists(params_path):
+         with open(params_path, 'r') as f:
+            stored_params = json.load(f)
+         if stored_params != params:
+            raise ValueError(f"job parameters do not match the job in {job_path}: {stored_params}")
+         if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+               self.done = {line.strip() for line in f if line.strip()}
+         print(f"resuming job {job_path}, {len(self.done)} units complete")
+      else:
+         if os.path.exists(job_path):
+            shutil.rmtree(job_path)
+      os.makedirs(self.units_path, exist_ok=True)
+      with open(params_path, 'w') as f:
+         json.dump(params, f)
+      self.manifest = open(self.manifest_path, 'a')
+
+   @staticmethod
+   def unit_id(key, sensor, start, end):
+      '''Returns the id of the unit for channel key of sensor between the start and end dates.'''
+      return f"{sensor[0]}_{key}_{start}_{end}"
+
+   def unit_file(self, unit_id):
+      return os.path.join(self.units_path, unit_id + ".csv")
+
+   def get(self, unit_id, valid=None):
+      '''Returns the stored response content of a completed unit or None.
+
+         Args:
+            unit_id: (str)
+            valid: (function)
+               optional check of the content. Units failing it are downloaded again.
+
+         Returns:
+            (bytes)
+      '''
+      if unit_id not in self.done:
+         return None
+      try:
+         with open(self.unit_file(unit_id), 'rb') as f:
+            content = f.read()
+      except FileNotFoundError:
+         # Listed in the manifest but its file is gone. Download it again.
+         content = None
+      if content is None or (valid is not None and not valid(content)):
+         with self.lock:
+            self.done.discard(unit_id)
+         return None
+      with self.lock:
+         self.resumed += 1
+      return content
+
+   def put(self, unit_id, content):
+      '''Writes a completed unit to disk and records it in the manifest.
+
+         Args:
+            unit_id: (str)
+            content: (bytes)
+               raw ThingSpeak response
+      '''
+      full_path = self.unit_file(unit_id)
+      with open(full_path + ".tmp", 'wb') as f:
+         f.write(content)
+      os.replace(full_path + ".tmp", full_path)
+      with self.lock:
+         self.manifest.write(unit_id + "\n")
+         self.manifest.flush()
+         self.done.add(unit_id)
+
+   def fail(self, unit_id):
+      '''Records a unit that could not be downloaded.'''
+      with self.lock:
+         self.failed += 1
+
+   def close(self):
+      self.manifest.close()
+      print(f"job {self.job_path}: {len(self.done)} units complete, {self.resumed} resumed from disk, {self.failed} failed")
+
+   def remove(self):
+      '''Deletes the job folder once the assembled output has been written.'''
+      self.manifest.close()
+      shutil.rmtree(self.job_path, ignore_errors=True)
@@ -1,5 +1,5 @@
 # Visualize PA data on a map
-#  *** WARNING! *** this program deletes files from a temporary images folder. This is not safed off yet. Use at your own risk.
+#  *** WARNING! *** this program deletes the frames of earlier runs of the same video from the images folder. Use at your own risk.
 # James S. Lucas 20201206
 
 from datetime import date, datetime, timedelta
@@ -8,18 +8,39 @@ import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import colorcet as cc
+import cv2
+from PIL import Image, ImageDraw, ImageFont
+from matplotlib import font_manager
+import io
 import os
+import re
+import shutil
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import config
+from pa_compact import with_coords
+from pa_frames import frame_key, write_frame_manifest
 
 
-def cleanup_files(images_path, no_warning):
-    filelist = [ f for f in os.listdir(images_path) if f.endswith(".png") ]
+def manifest_path(root_path, prefix=''):
+    '''Returns the path of the frame manifest of the frames named with prefix.'''
+    return os.path.join(root_path + config.images_folder, prefix + 'frames.csv')
+
+
+def cleanup_files(images_path, no_warning, prefix=''):
+    '''Deletes the frames of an earlier run of the job that names its frames with prefix, and its frame
+       manifest. Frames of other jobs and other files in images_path are kept.'''
+    pattern = re.compile(re.escape(prefix) + r'\d+_frame\.png$')
+    filelist = [ f for f in os.listdir(images_path) if pattern.match(f) ]
+    if os.path.exists(os.path.join(images_path, prefix + 'frames.csv')):
+        filelist.append(prefix + 'frames.csv')
     if len(filelist) > 0:
         if not no_warning:
             while True:
                 print(" ")
-                choice = input("Warning! All files will be deleted from %s. Proceed (y/n)? " % images_path)
+                choice = input("Warning! %d files of earlier frames of this job will be deleted from %s. Proceed (y/n)? " % (len(filelist), images_path))
                 if choice == "y" or choice == "n":
                     if choice == "y":
                         for f in filelist:
@@ -35,32 +56,433 @@ def cleanup_files(images_path, no_warning):
                 os.remove(os.path.join(images_path, f))
 
 
+class MapRenderer:
+    '''Renders the map frames. The figure, basemap, colorbar, title and attribution are built once. Each frame
+       only updates the scatter offsets and colors and the timestamp text before saving.
+
+       Args:
+          root_path: (str)
+          map_plt: (numpy array)
+             basemap image
+          bbox: (list, float)
+             plot extent in the format left right bottom top
+          label: (str)
+             title
+          range: (list, int)
+             color range of readings. min max
+          marker: (int)
+             marker size
+          map: (str)
+             map style. d, l, lt or s
+          heatmap: (pa_heatmap.IDWGrid)
+             optional. draws the interpolated surface of the readings under the markers.
+          scale: (float)
+             resolution of the frames relative to full size, for previews. map_plt is expected to be scaled
+             to match. The figure keeps its full size in inches and the dpi is scaled, so the layout, text
+             and marker sizes scale with the frame.
+          prefix: (str)
+             start of the frame file names, so several jobs can share the images folder.
+    '''
+    def __init__(self, root_path, map_plt, bbox, label, range, marker, map, heatmap=None, scale=1, prefix=''):
+        if map == 'd':
+            map_text_color = 'w'
+        elif map == 'l' or map == 'lt' or map =='s':
+            map_text_color = 'navy'
+        mapbox_attribution = u"\u00A9"+" Mapbox"
+        dpi = 96
+        mapsize = map_plt.shape
+        self.images_path = root_path + config.images_folder
+        self.prefix = prefix
+        self.frame_shape = None
+        self.fig, self.ax = plt.subplots(figsize = (mapsize[1]/dpi/scale, mapsize[0]/dpi/scale), dpi = plt.rcParams['figure.dpi']*scale)
+        ax = self.ax
+        ax.set_axis_off()
+        #ax.scatter(df.Lon, df.Lat, zorder=1, alpha=0.8, c=df.Ipm25, s=18, cmap=cc.cm.fire, vmin=20, vmax=255)
+        #ax.scatter(df.Lon, df.Lat, zorder=1, alpha=0.7, c=df.Ipm25, s=marker, cmap=cc.cm.fire_r, vmin=range[0], vmax=range[1])
+        self.scatter = ax.scatter([], [], zorder=1, alpha=0.2, c=[], s=marker, cmap=cc.cm.fire_r, vmin=range[0], vmax=range[1])
+        ax.set_title(label, fontsize=14)
+        #ax.text(0.06, 0.06, str(start_time), fontsize=10, transform=ax.transAxes, color=map_text_color)
+        self.time_text = ax.text(0.06, 0.96, '', fontsize=14, transform=ax.transAxes, color=map_text_color)
+        self.attribution = ax.text(0.02, 0.02, mapbox_attribution, transform=ax.transAxes, color=map_text_color)
+        ax.set_xlim(bbox[0],bbox[1])
+        ax.set_ylim(bbox[2],bbox[3])
+        im = ax.imshow(map_plt, zorder=0, extent=bbox, aspect='auto', cmap=cc.cm.fire_r, vmin=range[0], vmax=range[1])
+        self.heatmap = heatmap
+        if heatmap is not None:
+            self.heat = ax.imshow(np.full(heatmap.shape, np.nan), zorder=0.5, extent=bbox, aspect='auto', alpha=self.heat_alpha,
+                                  interpolation='bilinear', cmap=cc.cm.fire_r, vmin=range[0], vmax=range[1])
+        cb = self.fig.colorbar(im, ax=ax, pad=0.01, aspect=50)
+        cb.ax.tick_params(labelsize=14)
+
+    heat_alpha = 0.5
+
+    def update(self, df, start_time):
+        '''Updates the markers and timestamp for a frame.'''
+        self.scatter.set_offsets(np.column_stack((df.Lon, df.Lat)))
+        self.scatter.set_array(np.asarray(df['PM2.5_ATM_ug/m3']))
+        self.time_text.set_text(str(start_time))
+        if self.heatmap is not None:
+            self.heat.set_data(self.heatmap.frame_surface(df))
+
+    def render(self, df, start_time):
+        '''Renders a frame in memory with the same size and pixels as the saved png.
+
+           Returns:
+              (numpy array) height x width x 3 RGB, uint8
+        '''
+        self.update(df, start_time)
+        plt.rcParams['savefig.facecolor']='white'
+        buffer = io.BytesIO()
+        if self.frame_shape is None:
+            # The tight bounding box, and with it the frame size, is the same for every frame.
+            self.fig.savefig(buffer, format='png', bbox_inches='tight', pad_inches=0.05)
+            frame = np.asarray(Image.open(buffer).convert('RGB'))
+            self.frame_shape = frame.shape[:2]
+            return frame
+        self.fig.savefig(buffer, format='rgba', bbox_inches='tight', pad_inches=0.05)
+        frame = np.frombuffer(buffer.getbuffer(), dtype=np.uint8).reshape(self.frame_shape + (4,))
+        return frame[..., :3]
+
+    def frame_path(self, fig_num):
+        return self.images_path + os.path.sep + self.prefix + str(fig_num) + '_frame.png'
+
+    def save(self, df, fig_num, start_time):
+        '''Renders a frame to the images folder.
+
+           Returns:
+              (int) next frame number
+        '''
+        self.update(df, start_time)
+        img_fname = self.frame_path(fig_num)
+        plt.rcParams['savefig.facecolor']='white'
+        self.fig.savefig(img_fname, bbox_inches='tight', pad_inches=0.05)
+        return fig_num + 1
+
+    def close(self):
+        plt.close(self.fig)
+
+
+class BlitRenderer(MapRenderer):
+    '''MapRenderer that draws the static layers once. The basemap, colorbar, title and attribution are
+       rendered into a background pixel buffer. Each frame restores the buffer, draws only the markers and
+       timestamp over it and crops the canvas to the tight bounding box used for saved frames. The crop is
+       aligned to whole pixels, so edges can be anti-aliased slightly differently than in MapRenderer frames.
+    '''
+    def __init__(self, root_path, map_plt, bbox, label, range, marker, map, heatmap=None, scale=1, prefix=''):
+        super().__init__(root_path, map_plt, bbox, label, range, marker, map, heatmap, scale, prefix)
+        self.scatter.set_animated(True)
+        self.time_text.set_animated(True)
+        if heatmap is not None:
+            # The heatmap is drawn under the attribution, so the attribution is drawn over it per frame.
+            self.heat.set_animated(True)
+            self.attribution.set_animated(True)
+        canvas = self.fig.canvas
+        canvas.draw()
+        self.background = canvas.copy_from_bbox(self.fig.bbox)
+        width, height = canvas.get_width_height()
+        tight = self.fig.get_tightbbox(canvas.get_renderer()).padded(0.05).transformed(self.fig.dpi_scale_trans)
+        # savefig truncates the tight size to whole pixels and shifts the drawing by the bbox origin.
+        top = int(round(height - tight.y0 - int(tight.height)))
+        left = int(round(tight.x0))
+        self.rows = slice(max(0, top), min(height, top + int(tight.height)))
+        self.columns = slice(max(0, left), min(width, left + int(tight.width)))
+
+    def render(self, df, start_time):
+        self.update(df, start_time)
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        if self.heatmap is not None:
+            self.ax.draw_artist(self.heat)
+            self.ax.draw_artist(self.attribution)
+        self.ax.draw_artist(self.scatter)
+        self.ax.draw_artist(self.time_text)
+        return np.asarray(canvas.buffer_rgba())[self.rows, self.columns, :3].copy()
+
+    def save(self, df, fig_num, start_time):
+        Image.fromarray(self.render(df, start_time)).save(self.frame_path(fig_num))
+        return fig_num + 1
+
+
+class RasterRenderer(BlitRenderer):
+    '''Renders frames without matplotlib after the first draw. The static background is taken from
+       BlitRenderer. Each frame projects the sensor coordinates to pixels with the fixed axes transform,
+       colors the readings through the colormap lookup table and alpha composites a precomputed marker sprite
+       for each sensor onto the background with numpy. The timestamp is drawn with PIL in the same font. A
+       heatmap surface is colored through the same lookup table and scaled to the axes with cv2.
+       Marker and text anti-aliasing differ slightly from the matplotlib renderers.
+    '''
+    def __init__(self, root_path, map_plt, bbox, label, range, marker, map, heatmap=None, scale=1, prefix=''):
+        super().__init__(root_path, map_plt, bbox, label, range, marker, map, heatmap, scale, prefix)
+        canvas = self.fig.canvas
+        width, height = canvas.get_width_height()
+        self.background_pixels = np.asarray(canvas.buffer_rgba())[self.rows, self.columns, :3].copy()
+        if heatmap is not None:
+            # Pixels of the attribution, pasted over the heatmap.
+            self.ax.draw_artist(self.attribution)
+            attribution = np.asarray(canvas.buffer_rgba())[self.rows, self.columns, :3]
+            self.attribution_mask = np.any(attribution != self.background_pixels, axis=2)
+            self.attribution_pixels = attribution[self.attribution_mask]
+        # Data to frame pixel transform. The axes transform is affine, so two points fix it.
+        (x0, y0), (x1, y1) = self.ax.transData.transform([(bbox[0], bbox[2]), (bbox[1], bbox[3])])
+        self.x_scale = (x1 - x0) / (bbox[1] - bbox[0])
+        self.x_offset = x0 - self.x_scale * bbox[0] - self.columns.start
+        self.y_scale = -(y1 - y0) / (bbox[3] - bbox[2])
+        self.y_offset = height - y0 - self.y_scale * bbox[2] - self.rows.start
+        clip = self.ax.bbox
+        self.clip = (
+            int(round(clip.x0)) - self.columns.start, int(round(height - clip.y1)) - self.rows.start,
+            int(round(clip.x1)) - self.columns.start, int(round(height - clip.y0)) - self.rows.start
+            )
+        # Marker colors. The same lookup table and normalization as the scatter.
+        cmap = self.scatter.get_cmap()
+        self.lut = np.round(cmap(np.arange(cmap.N))[:, :3] * 255).astype(np.float32)
+        self.vmin, self.vmax = range
+        self.sprite = self.marker_sprite(marker, self.scatter.get_linewidths()[0], self.scatter.get_alpha(), self.fig.dpi)
+        # Timestamp
+        self.font = ImageFont.truetype(font_manager.findfont(self.time_text.get_fontproperties()), int(round(self.time_text.get_fontsize() * self.fig.dpi / 72)))
+        tx, ty = self.ax.transAxes.transform(self.time_text.get_position())
+        self.text_xy = (tx - self.columns.start, height - ty - self.rows.start)
+        self.text_fill = tuple(int(round(c * 255)) for c in mpl.colors.to_rgb(self.time_text.get_color()))
+
+    @staticmethod
+    def marker_sprite(marker, linewidth, alpha, dpi, supersample=4):
+        '''Returns the opacity of a scatter marker as a square float32 array. A filled circle of area marker
+           points squared with an edge of linewidth points in the same color, as drawn by matplotlib.
+        '''
+        radius = np.sqrt(marker) / 2 * dpi / 72
+        half_edge = linewidth / 2 * dpi / 72
+        size = int(np.ceil(radius + half_edge)) * 2 + 1
+        grid = (np.arange(size * supersample) + 0.5) / supersample - size / 2
+        distance = np.hypot(grid[:, None], grid[None, :])
+        fill = (distance <= radius).reshape(size, supersample, size, supersample).mean(axis=(1, 3))
+        edge = (np.abs(distance - radius) <= half_edge).reshape(size, supersample, size, supersample).mean(axis=(1, 3))
+        return (1 - (1 - alpha * fill) * (1 - alpha * edge)).astype(np.float32)
+
+    def render(self, df, start_time):
+        frame = self.background_pixels.copy()
+        if self.heatmap is not None:
+            self.draw_heatmap(frame, self.heatmap.frame_surface(df))
+            frame[self.attribution_mask] = self.attribution_pixels
+        values = np.asarray(df['PM2.5_ATM_ug/m3'], dtype=np.float64)
+        keep = ~np.isnan(values)
+        x = np.asarray(df.Lon, dtype=np.float64)[keep] * self.x_scale + self.x_offset
+        y = np.asarray(df.Lat, dtype=np.float64)[keep] * self.y_scale + self.y_offset
+        colors = self.colors(values[keep])
+        size = len(self.sprite)
+        left = np.round(x).astype(np.intp) - size // 2
+        top = np.round(y).astype(np.intp) - size // 2
+        cx0, cy0, cx1, cy1 = self.clip
+        for l, t, color in zip(left, top, colors):
+            x0, y0, x1, y1 = max(l, cx0), max(t, cy0), min(l + size, cx1), min(t + size, cy1)
+            if x0 >= x1 or y0 >= y1:
+                continue
+            alpha = self.sprite[y0 - t:y1 - t, x0 - l:x1 - l, None]
+            patch = frame[y0:y1, x0:x1].astype(np.float32)
+            frame[y0:y1, x0:x1] = patch + (color - patch) * alpha + 0.5
+        self.draw_text(frame, str(start_time))
+        return frame
+
+    def colors(self, values):
+        '''Returns the RGB colors of values from the colormap lookup table as float32.'''
+        index = np.clip(np.floor((values - self.vmin) / (self.vmax - self.vmin) * len(self.lut)), 0, len(self.lut) - 1)
+        return self.lut[index.astype(np.intp)]
+
+    def draw_heatmap(self, frame, surface):
+        '''Blends a heatmap surface over the axes area of the frame.'''
+        cx0, cy0, cx1, cy1 = self.clip
+        present = ~np.isnan(surface)
+        alpha = present.astype(np.float32) * self.heat_alpha
+        # Scaled premultiplied, so cells without a value do not bleed into their neighbours.
+        color = self.colors(np.where(present, surface, self.vmin)) * alpha[..., None]
+        size = (cx1 - cx0, cy1 - cy0)
+        color = cv2.resize(color, size, interpolation=cv2.INTER_LINEAR)
+        alpha = cv2.resize(alpha, size, interpolation=cv2.INTER_LINEAR)[..., None]
+        y0, x0 = max(0, cy0), max(0, cx0)
+        y1, x1 = min(frame.shape[0], cy1), min(frame.shape[1], cx1)
+        patch = frame[y0:y1, x0:x1].astype(np.float32)
+        color = color[y0 - cy0:y1 - cy0, x0 - cx0:x1 - cx0]
+        alpha = alpha[y0 - cy0:y1 - cy0, x0 - cx0:x1 - cx0]
+        frame[y0:y1, x0:x1] = patch * (1 - alpha) + color + 0.5
+
+    def draw_text(self, frame, text):
+        '''Draws the timestamp into the frame, only converting the pixels it covers to a PIL image.'''
+        x, y = self.text_xy
+        l, t, r, b = self.font.getbbox(text, anchor='ls')
+        x0, y0 = max(0, int(np.floor(x + l)) - 1), max(0, int(np.floor(y + t)) - 1)
+        x1, y1 = min(frame.shape[1], int(np.ceil(x + r)) + 1), min(frame.shape[0], int(np.ceil(y + b)) + 1)
+        if x0 >= x1 or y0 >= y1:
+            return
+        image = Image.fromarray(frame[y0:y1, x0:x1])
+        ImageDraw.Draw(image).text((x - x0, y - y0), text, font=self.font, fill=self.text_fill, anchor='ls')
+        frame[y0:y1, x0:x1] = np.asarray(image)
+
+
+# Frame renderers selectable with pa_map_vis.py --renderer
+RENDERERS = {
+    'mpl': MapRenderer,
+    'blit': BlitRenderer,
+    'raster': RasterRenderer,
+    }
+
+
+def repeat_png(src, dst):
+    '''Repeats a saved frame under a new frame number, as a hard link where the file system allows it.'''
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def render_range(renderer, frame_index, sensors, fig_num, stream=None, save_png=True, stamp='frame'):
+    '''Renders the frames of a frame index with a renderer. Frames are saved as png files or, with a stream,
+       handed to the video encoder in memory and only saved as png files if save_png is set.
+
+       A frame that shows the same readings and timestamp as the frame before it is not rendered again. The
+       last frame is repeated instead, as a hard link to its png file or by passing the same image to the
+       stream.
+
+       Returns:
+          (int, int, list) next frame number, frames repeated, frame manifest rows of the saved png files
+    '''
+    last_key = None
+    last_frame = None
+    repeated = 0
+    rows = []
+    for n in range(len(frame_index)):
+        readings = frame_index.frame(n)
+        start_time = frame_index.label_time(n, stamp)
+        key = frame_key(readings, str(start_time))
+        if save_png:
+            rows.append((fig_num, os.path.basename(renderer.frame_path(fig_num)), start_time.isoformat(), key.hex()))
+        if key == last_key:
+            if stream is not None:
+                stream.write(last_frame)
+            if save_png:
+                repeat_png(renderer.frame_path(fig_num - 1), renderer.frame_path(fig_num))
+            repeated += 1
+            fig_num = fig_num + 1
+            continue
+        last_key = key
+        df2 = with_coords(readings, sensors)
+        if stream is None:
+            fig_num = renderer.save(df2, fig_num, start_time)
+            continue
+        last_frame = renderer.render(df2, start_time)
+        stream.write(last_frame)
+        if save_png:
+            Image.fromarray(last_frame).save(renderer.frame_path(fig_num))
+        fig_num = fig_num + 1
+    return fig_num, repeated, rows
+
+
+def _render_worker(shm_name, shape, dtype, root_path, frame_index, sensors, fig_num, renderer_name, plot_args, stamp):
+    '''Process pool entry point. Attaches to the shared basemap and renders a contiguous run of frames.
+
+       Returns:
+          (int, int, float, list) frames, frames repeated, seconds, frame manifest rows
+    '''
+    plt.switch_backend('Agg')
+    start = time.perf_counter()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        map_plt = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        renderer = RENDERERS[renderer_name](root_path, map_plt, *plot_args)
+        fig_num, repeated, rows = render_range(renderer, frame_index, sensors, fig_num, stamp=stamp)
+        renderer.close()
+        del map_plt
+    finally:
+        shm.close()
+    return len(frame_index), repeated, time.perf_counter() - start, rows
+
+
+def render_frames(root_path, frame_index, sensors, map_plt, bbox, label, range, marker, map, workers=1, stream=None, save_png=True, renderer_name='mpl', stamp='frame', heatmap=None, scale=1, prefix=''):
+    '''Renders each frame of a frame index to the images folder, numbered from 1 in time order. The png
+       files are listed in order in the frame manifest at manifest_path(root_path, prefix).
+
+       With more than one worker the timeline is split into contiguous runs of frames, one per process. Each
+       process keeps its own MapRenderer and receives only the readings in its run. The basemap is placed in
+       shared memory once rather than being pickled to every process. Frame numbers do not depend on the
+       number of workers.
+
+       With a stream (pa_map_vid.VideoStream) the frames are rendered in one process and passed to the video
+       encoder in order without png files, unless save_png is set.
+
+       Repeated frames are only rendered once, see render_range(). With the default stamp every frame shows
+       its own start time, so only frames with stamp 'data', which shows the start time of the frame the
+       readings came from, can repeat.
+
+       Args:
+          root_path: (str)
+          frame_index: (pa_frames.FrameIndex or pa_matrix.SensorMatrix)
+             readings of each frame
+          sensors: (Pandas dataframe)
+             compact sensors table
+          map_plt: (numpy array)
+          bbox, label, range, marker, map:
+             see MapRenderer
+          workers: (int)
+          stream: (VideoStream)
+          save_png: (bool)
+          renderer_name: (str)
+             key of RENDERERS
+          stamp: (str)
+             frame or data
+          heatmap: (pa_heatmap.IDWGrid)
+          scale: (float)
+             see MapRenderer
+          prefix: (str)
+             see MapRenderer
+
+       Returns:
+          (int) next frame number
+    '''
+    plot_args = (bbox, label, range, marker, map, heatmap, scale, prefix)
+    frame_times = frame_index.frame_times
+    if stream is not None and workers > 1:
+        print("streaming frames to the video encoder. rendering in one process.")
+    if stream is not None or workers <= 1 or len(frame_times) < 2:
+        renderer = RENDERERS[renderer_name](root_path, map_plt, *plot_args)
+        fig_num, repeated, rows = render_range(renderer, frame_index, sensors, 1, stream, save_png, stamp)
+        renderer.close()
+        if save_png:
+            write_frame_manifest(manifest_path(root_path, prefix), rows)
+        print(f"{len(frame_times) - repeated} of {len(frame_times)} frames rendered. {repeated} renders saved by repeating unchanged frames.")
+        return fig_num
+    runs = [run for run in np.array_split(np.arange(len(frame_times)), workers) if len(run)]
+    shm = shared_memory.SharedMemory(create=True, size=map_plt.nbytes)
+    try:
+        np.ndarray(map_plt.shape, dtype=map_plt.dtype, buffer=shm.buf)[:] = map_plt
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=len(runs)) as executor:
+            futures = []
+            for run in runs:
+                futures.append(executor.submit(
+                    _render_worker, shm.name, map_plt.shape, map_plt.dtype.str, root_path,
+                    frame_index.run(run[0], run[-1]), sensors, int(run[0]) + 1, renderer_name, plot_args, stamp
+                    ))
+            results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start
+    finally:
+        shm.close()
+        shm.unlink()
+    for n, (run, (frames, repeated, seconds, rows)) in enumerate(zip(runs, results), 1):
+        print(f"worker {n}: frames {run[0] + 1}-{run[-1] + 1}, {frames} in {seconds:.1f} s ({frames / seconds:.2f} frames/s), {repeated} repeated")
+    repeated = sum(result[1] for result in results)
+    write_frame_manifest(manifest_path(root_path, prefix), [row for result in results for row in result[3]])
+    print(f"rendered {len(frame_times)} frames in {elapsed:.1f} s ({len(frame_times) / elapsed:.2f} frames/s) with {len(runs)} workers")
+    print(f"{len(frame_times) - repeated} of {len(frame_times)} frames rendered. {repeated} renders saved by repeating unchanged frames.")
+    return len(frame_times) + 1
+
+
+def preview_map(map_plt, scale):
+    '''Returns the basemap downsampled by scale for preview frames.'''
+    height, width = map_plt.shape[:2]
+    size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    return cv2.resize(map_plt, size, interpolation=cv2.INTER_AREA)
+
+
 def plot_map(root_path, df, map_plt, fig_num, start_time, bbox, label, range, marker, map):
-    if map == 'd':
-        map_text_color = 'w'
-    elif map == 'l' or map == 'lt' or map =='s':
-        map_text_color = 'navy'
-    mapbox_attribution = u"\u00A9"+" Mapbox"
-    dpi = 96
-    mapsize = map_plt.shape
-    images_path = root_path + config.images_folder
-    img_fname = images_path + os.path.sep + str(fig_num) + '_frame.png'
-    fig, ax = plt.subplots(figsize = (mapsize[1]/dpi, mapsize[0]/dpi))
-    ax.set_axis_off()
-    #ax.scatter(df.Lon, df.Lat, zorder=1, alpha=0.8, c=df.Ipm25, s=18, cmap=cc.cm.fire, vmin=20, vmax=255)
-    #ax.scatter(df.Lon, df.Lat, zorder=1, alpha=0.7, c=df.Ipm25, s=marker, cmap=cc.cm.fire_r, vmin=range[0], vmax=range[1])
-    ax.scatter(df.Lon, df.Lat, zorder=1, alpha=0.2, c=df['PM2.5_ATM_ug/m3'], s=marker, cmap=cc.cm.fire_r, vmin=range[0], vmax=range[1])
-    ax.set_title(label, fontsize=14)
-    #ax.text(0.06, 0.06, str(start_time), fontsize=10, transform=ax.transAxes, color=map_text_color)
-    ax.text(0.06, 0.96, str(start_time), fontsize=14, transform=ax.transAxes, color=map_text_color)
-    ax.text(0.02, 0.02, mapbox_attribution, transform=ax.transAxes, color=map_text_color)
-    ax.set_xlim(bbox[0],bbox[1])
-    ax.set_ylim(bbox[2],bbox[3])
-    im = ax.imshow(map_plt, zorder=0, extent=bbox, aspect='auto', cmap=cc.cm.fire_r, vmin=range[0], vmax=range[1])
-    cb = fig.colorbar(im, ax=ax, pad=0.01, aspect=50)
-    cb.ax.tick_params(labelsize=14)
-    plt.rcParams['savefig.facecolor']='white'
-    plt.savefig(img_fname, bbox_inches='tight', pad_inches=0.05)
-    plt.close('all')
-    fig_num += 1
-    return(fig_num)
\ No newline at end of file
+    renderer = MapRenderer(root_path, map_plt, bbox, label, range, marker, map)
+    fig_num = renderer.save(df, fig_num, start_time)
+    renderer.close()
+    return(fig_num)
@@ -2,8 +2,21 @@
 #James S. Lucas 20201023
 
 import cv2
+import hashlib
+import json
+import numpy as np
 import os
+import queue
 import re
+import shutil
+import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+from pa_frames import read_frame_manifest
 
 def tryint(s):
     try:
@@ -24,36 +37,376 @@ def sort_nicely(l):
     return(l)
 
 
+class OpenCVEncoder:
+    """ mp4v video written with cv2.VideoWriter. The video is opened with the size of the
+        first frame. Frames are height x width x 3 BGR uint8 arrays.
+    """
+    def __init__(self, vid_full_file_path, frames):
+        self.vid_full_file_path = vid_full_file_path
+        self.frames = frames
+        self.count = 0
+        self.start = None
+        self.opened = False
+
+    def open(self, width, height):
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        self.video = cv2.VideoWriter(self.vid_full_file_path, fourcc, self.frames, (width, height))
+
+    def encode(self, frame):
+        self.video.write(frame)
+
+    def release(self):
+        self.video.release()
+
+    def write(self, frame):
+        if not self.opened:
+            self.start = time.perf_counter()
+            height, width = frame.shape[:2]
+            self.size = (width, height)
+            self.open(width, height)
+            self.opened = True
+        self.encode(frame)
+        self.count += 1
+
+    def close(self):
+        """ Finishes the video and returns the encoding statistics (see encode_stats()).
+        """
+        if not self.opened:
+            return None
+        self.release()
+        stats = encode_stats(self.vid_full_file_path, self.count, self.frames, time.perf_counter() - self.start)
+        stats['size'] = self.size
+        return stats
+
+
+class FFmpegEncoder(OpenCVEncoder):
+    """ H.264 video encoded by a local ffmpeg process with libx264. Raw BGR frames are
+        written to its stdin. preset and crf are the libx264 speed / quality settings.
+        Odd frame sizes are cropped by a pixel to the even size H.264 needs.
+    """
+    def __init__(self, vid_full_file_path, frames, preset='medium', crf=23):
+        super().__init__(vid_full_file_path, frames)
+        self.preset = preset
+        self.crf = crf
+
+    def open(self, width, height):
+        if shutil.which('ffmpeg') is None:
+            raise RuntimeError("ffmpeg not found. install ffmpeg or use the opencv encoder.")
+        self.process = subprocess.Popen(
+            ['ffmpeg', '-y', '-loglevel', 'error',
+             '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '%dx%d' % (width, height), '-r', str(self.frames), '-i', '-',
+             '-vf', 'crop=trunc(iw/2)*2:trunc(ih/2)*2', '-c:v', 'libx264', '-preset', self.preset, '-crf', str(self.crf),
+             '-pix_fmt', 'yuv420p', '-movflags', '+faststart', self.vid_full_file_path],
+            stdin=subprocess.PIPE)
+
+    def encode(self, frame):
+        try:
+            self.process.stdin.write(np.ascontiguousarray(frame).tobytes())
+        except BrokenPipeError:
+            raise RuntimeError("ffmpeg exited with code %s" % self.process.wait())
+
+    def release(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError("ffmpeg exited with code %s" % self.process.returncode)
+
+
+# Video encoders selectable with --encoder
+ENCODERS = {
+    'opencv': OpenCVEncoder,
+    'x264': FFmpegEncoder,
+    }
+
+
+def make_encoder(vid_full_file_path, frames, encoder='opencv', preset='medium', crf=23):
+    if encoder == 'x264':
+        if shutil.which('ffmpeg') is not None:
+            return FFmpegEncoder(vid_full_file_path, frames, preset, crf)
+        print("ffmpeg not found. encoding the video with opencv.")
+        encoder = 'opencv'
+    return ENCODERS[encoder](vid_full_file_path, frames)
+
+
+def encode_stats(vid_full_file_path, count, frames, seconds):
+    """ Returns the encode rate and output bitrate of a finished video as a dictionary.
+    """
+    size = os.path.getsize(vid_full_file_path)
+    duration = count / frames
+    return {
+        'frames': count,
+        'seconds': seconds,
+        'fps': count / seconds if seconds > 0 else 0,
+        'bytes': size,
+        'kbps': size * 8 / duration / 1000 if duration > 0 else 0,
+        }
+
+
+def print_stats(stats):
+    if stats is not None:
+        print("encoded %d frames in %.1f s (%.1f frames/s). %.1f MB, %.0f kb/s" % (
+            stats['frames'], stats['seconds'], stats['fps'], stats['bytes'] / 1e6, stats['kbps']))
+
+
+def encode_images(image_paths, vid_full_file_path, frames, workers=4, prefetch=16, encoder='opencv', preset='medium', crf=23):
+    """ Encodes image files, in the given order, into one video.
+        Images are decoded ahead of the encoder on a pool of workers threads (cv2 releases
+        the GIL while decoding). At most prefetch decoded frames are held in memory.
+        Returns the encoding statistics.
+    """
+    video = make_encoder(vid_full_file_path, frames, encoder, preset, crf)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = deque()
+        paths = iter(image_paths)
+        for path in islice(paths, max(1, prefetch)):
+            pending.append(executor.submit(cv2.imread, path))
+
+        # Appending the images to the video one by one 
+        # the video width, height are those of the first image
+        while pending:
+            frame = pending.popleft().result()
+            path = next(paths, None)
+            if path is not None:
+                pending.append(executor.submit(cv2.imread, path))
+            video.write(frame)  
+
+    return video.close()  # releasing the video generated
+
+
+def concat_videos(segment_paths, vid_full_file_path):
+    """ Joins mp4 segments encoded with the same settings into one video with the ffmpeg
+        concat demuxer. The streams are copied, not re-encoded.
+    """
+    list_path = vid_full_file_path + ".segments.txt"
+    with open(list_path, 'w') as f:
+        for path in segment_paths:
+            f.write("file '" + os.path.abspath(path).replace("'", "'\\''") + "'\n")
+    try:
+        subprocess.run(
+            ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+             '-c', 'copy', '-movflags', '+faststart', vid_full_file_path],
+            check=True)
+    finally:
+        os.remove(list_path)
+
+
+def encode_segments(image_paths, vid_full_file_path, frames, segments, workers=4, prefetch=16, encoder='opencv', preset='medium', crf=23):
+    """ Splits the ordered image files into contiguous segments, encodes each segment in its
+        own process and joins them with concat_videos(). Each segment starts on a key frame,
+        so the joined video plays the same as one encoded in a single pass.
+    """
+    runs = [run for run in np.array_split(np.arange(len(image_paths)), segments) if len(run)]
+    segment_paths = [vid_full_file_path + ".part%03d.mp4" % n for n in range(len(runs))]
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=len(runs)) as executor:
+            futures = [
+                executor.submit(encode_images, [image_paths[i] for i in run], path, frames, workers, prefetch, encoder, preset, crf)
+                for run, path in zip(runs, segment_paths)
+                ]
+            results = [future.result() for future in futures]
+        concat_videos(segment_paths, vid_full_file_path)
+    finally:
+        for path in segment_paths:
+            if os.path.exists(path):
+                os.remove(path)
+    print("%d segments joined." % len(runs))
+    stats = encode_stats(vid_full_file_path, len(image_paths), frames, time.perf_counter() - start)
+    stats['size'] = results[0]['size']
+    return stats
+
+
+class SegmentedVideo:
+    """ A video kept as encoded segments so new frames can be appended without encoding the
+        earlier frames again. The segments and a manifest.json listing them are kept in a
+        folder next to the video, <video name>_segments. Each append encodes one more segment
+        and re-muxes the video from all segments with concat_videos(). All segments must have
+        the same frame rate, encoder settings and frame size.
+    """
+    def __init__(self, vid_full_file_path, frames, encoder='opencv', preset='medium', crf=23):
+        self.vid_full_file_path = vid_full_file_path
+        self.segments_path = os.path.splitext(vid_full_file_path)[0] + '_segments'
+        self.manifest_path = os.path.join(self.segments_path, 'manifest.json')
+        self.settings = {'frames': frames, 'encoder': encoder}
+        if encoder == 'x264':
+            self.settings.update({'preset': preset, 'crf': crf})
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+            if self.manifest['settings'] != self.settings:
+                raise ValueError("%s was encoded with %s. append with the same frame rate and encoder settings." % (
+                    vid_full_file_path, self.manifest['settings']))
+        elif os.path.exists(vid_full_file_path):
+            raise ValueError("%s was not encoded in segments and can not be appended to. remove it or use another name." % (
+                vid_full_file_path))
+        else:
+            self.manifest = {'settings': self.settings, 'size': None, 'segments': []}
+
+    def __len__(self):
+        return sum(segment['frames'] for segment in self.manifest['segments'])
+
+    def last_key(self):
+        segments = self.manifest['segments']
+        return segments[-1]['key'] if segments else None
+
+    def next_path(self):
+        """ Returns the path to encode the next segment to.
+        """
+        os.makedirs(self.segments_path, exist_ok=True)
+        return os.path.join(self.segments_path, '%05d.mp4' % len(self.manifest['segments']))
+
+    def add(self, stats, key=None):
+        """ Adds the segment encoded to next_path() and re-muxes the video from all segments.
+
+            Args:
+                stats: (dict)
+                    encoding statistics of the segment
+                key: (str)
+                    identifies the frames of the segment
+        """
+        path = self.next_path()
+        size = list(stats['size'])
+        if self.manifest['size'] not in (None, size):
+            os.remove(path)
+            raise ValueError("the new frames are %dx%d. the frames of %s are %dx%d." % (
+                size[0], size[1], self.vid_full_file_path, self.manifest['size'][0], self.manifest['size'][1]))
+        self.manifest['size'] = size
+        self.manifest['segments'].append({
+            'file': os.path.basename(path),
+            'frames': stats['frames'],
+            'key': key,
+            'added': datetime.now().isoformat(timespec='seconds'),
+            })
+        # The video and then the manifest are replaced whole, so an interrupted append leaves
+        # the previous video and an unlisted segment that the next append overwrites.
+        remux_path = os.path.splitext(self.vid_full_file_path)[0] + '.remux.mp4'
+        concat_videos([os.path.join(self.segments_path, segment['file']) for segment in self.manifest['segments']], remux_path)
+        os.replace(remux_path, self.vid_full_file_path)
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+
+def frames_key(image_paths):
+    """ Returns a digest of the names, sizes and modification times of image files.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for path in image_paths:
+        info = os.stat(path)
+        digest.update(("%s %d %d\n" % (os.path.basename(path), info.st_size, info.st_mtime_ns)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def append_video(image_paths, vid_full_file_path, frames, workers=4, prefetch=16, segments=1, encoder='opencv', preset='medium', crf=23):
+    """ Appends image files, in the given order, to a SegmentedVideo. Only the new images are
+        encoded, so the time an update takes grows with the new frames rather than with the
+        length of the video. Images identical to the last ones appended are skipped.
+        Returns the encoding statistics of the new segment.
+    """
+    video = SegmentedVideo(vid_full_file_path, frames, encoder, preset, crf)
+    key = frames_key(image_paths)
+    if key == video.last_key():
+        print("these frames were already appended to %s." % vid_full_file_path)
+        return None
+    path = video.next_path()
+    if segments > 1 and len(image_paths) > 1:
+        stats = encode_segments(image_paths, path, frames, segments, workers, prefetch, encoder, preset, crf)
+    else:
+        stats = encode_images(image_paths, path, frames, workers, prefetch, encoder, preset, crf)
+    if stats is None:
+        return None
+    video.add(stats, key)
+    print("appended %d frames to %s. %d frames in %d segments." % (
+        stats['frames'], vid_full_file_path, len(video), len(video.manifest['segments'])))
+    return stats
+
+
 # Video Generating function 
-def generate_video(images_path, vid_full_file_path, frames): 
-    os.chdir(images_path) 
-      
-    images = [img for img in os.listdir(images_path) 
-              if img.endswith(".jpg") or
-                 img.endswith(".jpeg") or
-                 (img.endswith(".png") and not img.startswith("map"))] 
-    images = sort_nicely(images)
-
-    # Array images should only consider 
-    # the image files ignoring others if any 
-  
-    frame = cv2.imread(os.path.join(images_path, images[0])) 
-  
-    # setting the frame width, height width 
-    # the width, height of first image 
-    height, width, layers = frame.shape   
-  
-  
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    video = cv2.VideoWriter(vid_full_file_path, fourcc, frames, (width, height))  
+def generate_video(images_path, vid_full_file_path, frames, workers=4, prefetch=16, segments=1, encoder='opencv', preset='medium', crf=23, append=False, manifest=None): 
+    """ Encodes the frames listed in a frame manifest (see pa_frames) in its order. Without a
+        manifest, the image files in images_path are encoded in natural sort order.
+        With segments > 1 the frames are encoded in that many processes and joined with
+        ffmpeg, if it is installed. Otherwise they are encoded in a single pass.
+        encoder is a key of ENCODERS. preset and crf apply to the x264 encoder.
+        With append the frames are added to the end of the video (see append_video()).
+        Appending requires ffmpeg.
+    """
+    if manifest is not None:
+        # The render stage lists its frames in order, so the folder is not scanned or sorted.
+        image_paths = [row['path'] for row in read_frame_manifest(manifest)]
+    else:
+        images = [img for img in os.listdir(images_path) 
+                  if img.endswith(".jpg") or
+                     img.endswith(".jpeg") or
+                     (img.endswith(".png") and not img.startswith("map"))] 
+        images = sort_nicely(images)
 
-    # Appending the images to the video one by one 
-    for image in images:  
-        video.write(cv2.imread(os.path.join(images_path, image)))  
+        # Array images should only consider 
+        # the image files ignoring others if any 
+        image_paths = [os.path.join(images_path, image) for image in images]
+
+    if append and shutil.which('ffmpeg') is None:
+        print("error. ffmpeg not found. it is required to append to a video.")
+        return
+    if segments > 1 and shutil.which('ffmpeg') is None:
+        print("ffmpeg not found. encoding the video in a single pass.")
+        segments = 1
+    if append:
+        stats = append_video(image_paths, vid_full_file_path, frames, workers, prefetch, segments, encoder, preset, crf)
+    elif segments > 1 and len(image_paths) > 1:
+        stats = encode_segments(image_paths, vid_full_file_path, frames, segments, workers, prefetch, encoder, preset, crf)
+    else:
+        stats = encode_images(image_paths, vid_full_file_path, frames, workers, prefetch, encoder, preset, crf)
+    print_stats(stats)
       
     # Deallocating memories taken for window creation 
     cv2.destroyAllWindows()  
-    video.release()  # releasing the video generated 
+
+class VideoStream:
+    """ Encodes frames handed over in memory, in order, without writing image files.
+        Frames go through a bounded queue to a writer thread so rendering the next
+        frame overlaps encoding the last one. The video size is taken from the first frame.
+    """
+    def __init__(self, vid_full_file_path, frames, queue_size=8, encoder='opencv', preset='medium', crf=23):
+        self.video = make_encoder(vid_full_file_path, frames, encoder, preset, crf)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = None
+        self.error = None
+        self.count = 0
+
+    def write(self, frame):
+        """ Queues a height x width x 3 RGB uint8 frame. Blocks while the queue is full.
+        """
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._writer, daemon=True)
+            self.thread.start()
+        self.queue.put(frame)
+        self.count += 1
+
+    def _writer(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            if self.error is None:
+                try:
+                    self.video.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+                except Exception as e:
+                    self.error = e
+
+    def close(self):
+        """ Writes the queued frames and closes the video file.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+        stats = self.video.close()
+        print_stats(stats)
+        return stats
+
   
 if __name__ == "__main__":
     import argparse
@@ -66,24 +419,65 @@ if __name__ == "__main__":
         parser = argparse.ArgumentParser(
         description='generate time-lapse video from image files.',
         prog='pa_map_vid',
-        usage='%(prog)s [-o <filename>], [-f <frames per second>]',
+        usage='%(prog)s [-o <filename>], [-f <frames per second>], [-w <workers>], [-s <segments>], [-e <encoder>], [--preset <preset>], [--crf <crf>], [-a], [-m <manifest>]',
         formatter_class=argparse.RawDescriptionHelpFormatter,
         )
         g=parser.add_argument_group(title='arguments',
             description='''    -o, --output    optional.  filename prefix for the video.   
         -f  --frames                          optional.  frames per second.
+        -w  --workers                         optional.  number of threads decoding image files.
+        -s  --segments                        optional.  number of segments encoded in parallel. requires ffmpeg.
+        -e  --encoder                         optional.  opencv (mp4v) or x264 (H.264 with ffmpeg).
+            --preset                          optional.  x264 preset. ultrafast ... veryslow.
+            --crf                             optional.  x264 quality. lower is better quality and larger files.
+        -a  --append                          optional.  append the images to the end of the video. requires ffmpeg.
+        -m  --manifest                        optional.  frame manifest listing the images, e.g. frames.csv in the images folder.
 
              ''')
         g.add_argument('-o', '--output',
                         type=str,
                         default = 'no_name',
-                        dest='filename',
+                        dest='output',
                         help=argparse.SUPPRESS)
         g.add_argument('-f', '--frames',
                         type=int,
                         default = 15,
                         dest='frames',
                         help=argparse.SUPPRESS)
+        g.add_argument('-w', '--workers',
+                        type=int,
+                        default = 4,
+                        dest='workers',
+                        help=argparse.SUPPRESS)
+        g.add_argument('-s', '--segments',
+                        type=int,
+                        default = 1,
+                        dest='segments',
+                        help=argparse.SUPPRESS)
+        g.add_argument('-e', '--encoder',
+                        type=str,
+                        default = 'opencv',
+                        choices = list(ENCODERS),
+                        dest='encoder',
+                        help=argparse.SUPPRESS)
+        g.add_argument('--preset',
+                        type=str,
+                        default = 'medium',
+                        dest='preset',
+                        help=argparse.SUPPRESS)
+        g.add_argument('--crf',
+                        type=int,
+                        default = 23,
+                        dest='crf',
+                        help=argparse.SUPPRESS)
+        g.add_argument('-a', '--append', action='store_true',
+                        dest='append',
+                        help=argparse.SUPPRESS)
+        g.add_argument('-m', '--manifest',
+                        type=str,
+                        default = None,
+                        dest='manifest',
+                        help=argparse.SUPPRESS)
         args = parser.parse_args()
         return(args)
 
@@ -95,10 +489,15 @@ if __name__ == "__main__":
     images_path = config.root_path + os.path.sep + config.images_folder
     vid_full_file_path = config.root_path + os.path.sep + config.video_folder + os.path.sep + filename
 
-    files = glob.glob(images_path + os.path.sep + '*.png')
+    manifest = None
+    if args.manifest is not None:
+        manifest = os.path.join(images_path, args.manifest)
+        files = [manifest] if os.path.exists(manifest) else []
+    else:
+        files = glob.glob(images_path + os.path.sep + '*.png')
 
     if not files:
         print("error. no image files found.")
     else:
-        generate_video(images_path, vid_full_file_path, args.frames) 
+        generate_video(images_path, vid_full_file_path, args.frames, args.workers, segments=args.segments, encoder=args.encoder, preset=args.preset, crf=args.crf, append=args.append, manifest=manifest) 
         sys.exit()
\ No newline at end of file
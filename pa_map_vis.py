@@ -1,5 +1,5 @@
 # Visualize PA data on a map
-#  *** WARNING! *** this program deletes files from a temporary images folder. This is not safed off yet. Use at your own risk.
+#  *** WARNING! *** this program deletes the frames of earlier runs of the same video from the images folder. Use at your own risk.
 # James S. Lucas 20201226
 
 from datetime import datetime, timedelta
@@ -7,13 +7,20 @@ import pytz
 import pandas as pd
 import matplotlib.pyplot as plt
 import os
+import shutil
 import sys
 import argparse
 import config
 from pa_get_df import pa_get_df
+from pa_job import JobManifest
+from pa_store import read_store, store_modified
+from pa_compact import compact_dtypes, compact_readings, to_csv
+from pa_frames import FrameIndex
+from pa_matrix import SensorMatrix
+from pa_heatmap import IDWGrid
 from get_map import get_map
-from pa_map_vid import generate_video
-from pa_map_plot import cleanup_files, plot_map
+from pa_map_vid import generate_video, SegmentedVideo, VideoStream, ENCODERS
+from pa_map_plot import cleanup_files, manifest_path, preview_map, render_frames, RENDERERS
 
 
 root_path = config.root_path + os.path.sep
@@ -22,6 +29,8 @@ map_filename = 'map_dark.png'
 map_full_file_path = root_path + os.path.sep + map_filename 
 images_path = root_path + config.images_folder
 data_path = root_path + config.data_folder
+default_bbox = [-117.5298, 33.7180, -117.4166, 33.8188]
+plot_columns = ['Lon', 'Lat', 'Sensor', 'created_at', 'PM2.5_ATM_ug/m3', 'Ipm25']
 
 
 def valid_date(s):
@@ -36,12 +45,12 @@ def get_arguments():
     parser = argparse.ArgumentParser(
     description='generate time-lapse video of PA-II readings on a map.',
     prog='pa_map_plot',
-    usage='%(prog)s [-d <data>], [-b <bbox>], [-r <ramge>] [-v <video>], [-f <frames>], [-l <label>], [-o <output>], [-i <interval>], [-s <start>], [-e <end>], [--md], [--nw], [--map]',
+    usage='%(prog)s [-d <data>], [-b <bbox>], [-r <ramge>] [-v <video>], [-f <frames>], [-l <label>], [-o <output>], [-i <interval>], [-s <start>], [-e <end>], [--fw <workers>], [--rate <rate>], [--nocache], [--resume], [--md], [--nw], [--map], [-w <workers>], [--stream], [--png], [--renderer <renderer>], [--stamp <stamp>], [--carry <frames>], [--heatmap [<cell>]], [--matrix], [--smooth <frames>], [--ffill <frames>], [--preview <scale>], [--every <frames>], [--segments <segments>], [--encoder <encoder>], [--preset <preset>], [--crf <crf>], [--append]',
     formatter_class=argparse.RawDescriptionHelpFormatter,
     )
     g=parser.add_argument_group(title='arguments',
-          description='''    -d, --data    optional.  get data from either csv or ThingSpeak.
-    -b  --bbox                            optional.  bounding box coordinates, format  SE lon lat NW lon lat. omit SE and NW.
+          description='''    -d, --data    optional.  get data from csv, parquet/feather store (PQ) or ThingSpeak.
+    -b  --bbox                            optional.  bounding box coordinates, format  SE lon lat NW lon lat. omit SE and NW. filters PQ data.
     -r  --range                           optional.  color range of readings. min max
     -m  --marker                          optional.  size of sensor icon circle.
     -v  --video                           optional.  generate video. 
@@ -51,19 +60,40 @@ def get_arguments():
     -i  --interval                        optional.  data average interval. minutes. used for retriving data and the image frame increment.
     -s  --start                           optional.  start date. format "YYYY-MM-DD HH:MM:SS" include quotes. 
     -e  --end                             optional.  end date. format "YYYY-MM-DD HH:MM:SS" include quotes. 
-        --md                              optional.  use stored sensor metadata.
+        --fw                              optional.  number of concurrent ThingSpeak requests.
+        --rate                            optional.  maximum ThingSpeak requests per second. 0 for no limit.
+        --nocache                         optional.  do not use the local ThingSpeak response cache.
+        --resume                          optional.  resume an interrupted ThingSpeak download with the same arguments.
+        --md                              optional.  only use stored sensor metadata. do not query PurpleAir.
         --nw                              optional.  suppress file deletion warning. 
-        --map                             optional.  map backgound ((l)ight or (d)ark).                                ''')
+        --map                             optional.  map backgound ((l)ight or (d)ark).
+    -w  --workers                         optional.  number of processes rendering frames in parallel.
+        --stream                          optional.  make the video directly from the rendered frames without png files. implies -v.
+        --png                             optional.  with --stream, also save the png frames.
+        --renderer                        optional.  frame renderer. mpl (full matplotlib draw), blit (cached background) or raster (numpy).
+        --stamp                           optional.  frame timestamp. frame (start of the frame) or data (start of the frame the readings came from).
+        --carry                           optional.  number of frames in a row without readings that show the last readings.
+        --heatmap                         optional.  draw an interpolated surface of the readings. optional grid cell size in map pixels.
+        --matrix                          optional.  one mean reading per sensor and frame from a cached sensor x frame matrix.
+        --smooth                          optional.  with --matrix, rolling mean of each sensor over this many frames.
+        --ffill                           optional.  with --matrix, fill up to this many frames after a sensor's last reading.
+        --preview                         optional.  render low resolution preview frames at this scale, for example 0.25.
+        --every                           optional.  only render every Nth frame.
+        --segments                        optional.  encode the video in this many parallel segments joined with ffmpeg.
+        --encoder                         optional.  video encoder. opencv (mp4v) or x264 (H.264 with ffmpeg).
+        --preset                          optional.  x264 preset. ultrafast ... veryslow.
+        --crf                             optional.  x264 quality. lower is better quality and larger files.
+        --append                          optional.  append the frames to the video named by -o. implies -v. requires ffmpeg.     ''')
     g.add_argument('-d', '--data',
                     type=str,
                     default = 'TS',
-                    choices = ['CSV', 'TS'],
+                    choices = ['CSV', 'PQ', 'TS'],
                     dest='data',
                     help=argparse.SUPPRESS)
     g.add_argument('-b', '--bbox',
                     type=float,
                     nargs = 4,
-                    default = [-117.5298, 33.7180, -117.4166, 33.8188],
+                    default = None,
                     dest='bbox',
                     help=argparse.SUPPRESS)
     g.add_argument('-r', '--range',
@@ -106,6 +136,22 @@ def get_arguments():
     g.add_argument('-e', '--enddate', 
                     type=valid_date,
                     help=argparse.SUPPRESS)
+    g.add_argument('--fw',
+                    type=int,
+                    default = 1,
+                    dest='fetch_workers',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--rate',
+                    type=float,
+                    default = 0,
+                    dest='rate',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--nocache', action='store_false',
+                    dest='use_cache',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--resume', action='store_true',
+                    dest='resume',
+                    help=argparse.SUPPRESS)
     g.add_argument('--md', action='store_true',
                     dest='metadata',
                     help=argparse.SUPPRESS)
@@ -118,74 +164,256 @@ def get_arguments():
                     choices = ['d', 'l', 'lt', 's'],
                     dest='map',
                     help=argparse.SUPPRESS)
+    g.add_argument('-w', '--workers',
+                    type=int,
+                    default = 1,
+                    dest='workers',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--stream', action='store_true',
+                    dest='stream',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--png', action='store_true',
+                    dest='png',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--renderer',
+                    type=str,
+                    default = 'mpl',
+                    choices = list(RENDERERS),
+                    dest='renderer',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--stamp',
+                    type=str,
+                    default = 'frame',
+                    choices = ['frame', 'data'],
+                    dest='stamp',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--carry',
+                    type=int,
+                    default = 0,
+                    dest='carry',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--matrix', action='store_true',
+                    dest='matrix',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--smooth',
+                    type=int,
+                    default = 1,
+                    dest='smooth',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--ffill',
+                    type=int,
+                    default = 0,
+                    dest='ffill',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--preview',
+                    type=float,
+                    default = 1,
+                    dest='preview',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--every',
+                    type=int,
+                    default = 1,
+                    dest='every',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--segments',
+                    type=int,
+                    default = 1,
+                    dest='segments',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--encoder',
+                    type=str,
+                    default = 'opencv',
+                    choices = list(ENCODERS),
+                    dest='encoder',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--preset',
+                    type=str,
+                    default = 'medium',
+                    dest='preset',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--crf',
+                    type=int,
+                    default = 23,
+                    dest='crf',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--append', action='store_true',
+                    dest='append',
+                    help=argparse.SUPPRESS)
+    g.add_argument('--heatmap',
+                    type=int,
+                    nargs = '?',
+                    const = 4,
+                    default = None,
+                    dest='heatmap',
+                    help=argparse.SUPPRESS)
 
     args = parser.parse_args()
     return(args)
 
-args = get_arguments()
-
-if args.data == 'TS':
-    #           SE lon / lat            NW lon / lat
-    #bbox = [-117.5298, 33.7180, -117.4166, 33.8188]  #Temescal Valley
-    #bbox = [-122.9068, 37.1778, -121.6626, 38.4536]  #Bay Area
-    #bbox = [-118.4#32617,33.582019,-117.557831,34.009981]  #Lake Forest to Inglewood
-    bbox = args.bbox
-    bbox_plot = (bbox[0]-.004, bbox[2]+.004, bbox[1]-.004, bbox[3]+.004)
-    bbox_mapbox = (bbox[0]-.004, bbox[1]-.004, bbox[2]+.004, bbox[3]+.004)
-    bbox_pa = (str(bbox[0]), str(bbox[1]), str(bbox[2]), str(bbox[3]))
-    dfs = pa_get_df(args.startdate, args.enddate, bbox_pa, args.interval, 'a',args.metadata, args.output)
-    df = dfs['a']
-    data_file_full_path = data_path + os.path.sep + args.output + "_" + args.startdate.strftime("%Y%m%d") + "_" + args.enddate.strftime("%Y%m%d") + "_a" + ".csv"
-    df.to_csv(data_file_full_path, index=False, header=True)
-    if args.metadata:
+# The frame rendering process pool imports this module on platforms that spawn processes.
+if __name__ == "__main__":
+    args = get_arguments()
+
+    if args.data == 'TS':
+        #           SE lon / lat            NW lon / lat
+        #bbox = [-117.5298, 33.7180, -117.4166, 33.8188]  #Temescal Valley
+        #bbox = [-122.9068, 37.1778, -121.6626, 38.4536]  #Bay Area
+        #bbox = [-118.4#32617,33.582019,-117.557831,34.009981]  #Lake Forest to Inglewood
+        bbox = args.bbox if args.bbox is not None else default_bbox
+        bbox_plot = (bbox[0]-.004, bbox[2]+.004, bbox[1]-.004, bbox[3]+.004)
+        bbox_mapbox = (bbox[0]-.004, bbox[1]-.004, bbox[2]+.004, bbox[3]+.004)
+        bbox_pa = (str(bbox[0]), str(bbox[1]), str(bbox[2]), str(bbox[3]))
+        data_file_prefix = data_path + os.path.sep + args.output + "_" + args.startdate.strftime("%Y%m%d") + "_" + args.enddate.strftime("%Y%m%d") + "_"
+        job_params = {
+            'bbox': bbox_pa,
+            'start': str(args.startdate),
+            'end': str(args.enddate),
+            'interval': args.interval,
+            'channel': 'a'
+            }
+        job = JobManifest(data_file_prefix + "job", job_params, args.resume)
+        # The readings come back in the compact layout. The wide layout is only built in chunks for the csv file.
+        dfs = pa_get_df(args.startdate, args.enddate, bbox_pa, args.interval, 'a', args.metadata, args.output, args.fetch_workers, args.rate, use_cache=args.use_cache, job=job, compact=True)
+        sensors, readings = dfs['sensors'], dfs['a']
+        del dfs
+        data_file_full_path = data_file_prefix + "a" + ".csv"
+        to_csv(sensors, readings, data_file_full_path)
+        # Narrowed to float32 for the frames only after the csv keeps the full precision.
+        readings = compact_dtypes(readings)
+        if job.failed == 0:
+            job.remove()
+        if args.metadata:
+            shown = sensors.loc[readings['sensor_code'].unique()]
+            bbox = (shown.Lon.min(), shown.Lat.min(), shown.Lon.max(), shown.Lat.max())
+            bbox_plot = (bbox[0]-.004, bbox[2]+.004, bbox[1]-.004, bbox[3]+.004)
+            bbox_mapbox = (bbox[0]-.004, bbox[1]-.004, bbox[2]+.004, bbox[3]+.004)
+    elif args.data == 'CSV':
+        items = os.listdir(data_path)
+        file_list = [name for name in items if name.endswith("_a.csv")]
+        for n, fileName in enumerate(file_list, 1):
+            sys.stdout.write("[%d] %s\n\r" % (n, fileName))
+        choice = int(input("Select data file[1-%s]: " % n))
+        data_file_full_path = data_path + os.path.sep + file_list[choice-1]
+        df = pd.read_csv(data_file_full_path, usecols=plot_columns)
         bbox = (df.Lon.min(), df.Lat.min(), df.Lon.max(), df.Lat.max())
         bbox_plot = (bbox[0]-.004, bbox[2]+.004, bbox[1]-.004, bbox[3]+.004)
         bbox_mapbox = (bbox[0]-.004, bbox[1]-.004, bbox[2]+.004, bbox[3]+.004)
-elif args.data == 'CSV':
-    items = os.listdir(data_path)
-    file_list = [name for name in items if name.endswith("_a.csv")]
-    for n, fileName in enumerate(file_list, 1):
-        sys.stdout.write("[%d] %s\n\r" % (n, fileName))
-    choice = int(input("Select data file[1-%s]: " % n))
-    data_file_full_path = data_path + os.path.sep + file_list[choice-1]
-    df = pd.read_csv(data_file_full_path)
-    bbox = (df.Lon.min(), df.Lat.min(), df.Lon.max(), df.Lat.max())
-    bbox_plot = (bbox[0]-.004, bbox[2]+.004, bbox[1]-.004, bbox[3]+.004)
-    bbox_mapbox = (bbox[0]-.004, bbox[1]-.004, bbox[2]+.004, bbox[3]+.004)
-    
-
-df['created_at'] = pd.to_datetime(df['created_at'])
-
-fig_num = 1
-first_datetime = min(df['created_at'])
-last_datetime = max(df['created_at'])
-vid_filename = args.output + "_" + first_datetime.strftime("%Y%m%d") + "_" + last_datetime.strftime("%Y%m%d") + ".mp4"
-vid_full_file_path = root_path + config.video_folder + os.path.sep + vid_filename 
-
-
-if args.startdate is not None and args.enddate is not None:
-    if args.startdate > args.enddate:
-        print("error. start date greater than end date. exiting")
-        exit()
-    if args.enddate < args.startdate:
-        print("error. end date less than start date. exiting")
+    elif args.data == 'PQ':
+        items = os.listdir(data_path)
+        file_list = [name for name in items if name.endswith("_a.parquet") or name.endswith("_a.feather")]
+        for n, fileName in enumerate(file_list, 1):
+            sys.stdout.write("[%d] %s\n\r" % (n, fileName))
+        choice = int(input("Select data store[1-%s]: " % n))
+        data_file_full_path = data_path + os.path.sep + file_list[choice-1]
+        # Only the date range, bounding box and columns needed for the frames are read.
+        df = read_store(data_file_full_path, args.startdate, args.enddate, args.bbox, columns=plot_columns)
+        bbox = (df.Lon.min(), df.Lat.min(), df.Lon.max(), df.Lat.max())
+        bbox_plot = (bbox[0]-.004, bbox[2]+.004, bbox[1]-.004, bbox[3]+.004)
+        bbox_mapbox = (bbox[0]-.004, bbox[1]-.004, bbox[2]+.004, bbox[3]+.004)
+
+
+    if args.data == 'TS':
+        readings['created_at'] = pd.to_datetime(readings['created_at'])
+    else:
+        df['created_at'] = pd.to_datetime(df['created_at'])
+        # Keep the name and coordinates once per sensor rather than on every reading.
+        sensors, readings = compact_readings(df)
+        del df
+
+    first_datetime = min(readings['created_at'])
+    last_datetime = max(readings['created_at'])
+    vid_filename = args.output + "_" + first_datetime.strftime("%Y%m%d") + "_" + last_datetime.strftime("%Y%m%d") + ".mp4"
+    if args.append:
+        # An appended video covers every run, so its name has no dates.
+        vid_filename = args.output + ".mp4"
+    if args.preview != 1 or args.every > 1:
+        vid_filename = vid_filename.replace(".mp4", "_preview.mp4")
+    vid_full_file_path = root_path + config.video_folder + os.path.sep + vid_filename 
+    # Frames are named after the video so runs for different videos can share the images folder.
+    frame_prefix = os.path.splitext(vid_filename)[0] + "_"
+
+
+    if args.append and shutil.which('ffmpeg') is None:
+        print("error. ffmpeg not found. it is required to append to a video. exiting")
         exit()
-if args.startdate is not None:
-    start_time = pytz.utc.localize(args.startdate)
-else:
-    start_time = first_datetime
-if args.enddate is not None:
-    last_datetime = pytz.utc.localize(args.enddate)
-time_increment = timedelta(minutes = int(args.interval))
-
-get_map(map_full_file_path, args.map, bbox_mapbox)
-map_plt = plt.imread(map_full_file_path)
-cleanup_files(images_path, args.no_warning)
-while start_time <= last_datetime:
-    end_time = start_time + time_increment
-    df2 = df[(df['created_at'] >= start_time) & (df['created_at'] <= end_time)]
-    #print(df2)
-    fig_num = plot_map(root_path, df2, map_plt, fig_num, start_time, bbox_plot, args.label, args.range, args.marker, args.map)
-    start_time = end_time
-if args.video:
-    generate_video(images_path, vid_full_file_path, args.frames)
\ No newline at end of file
+    if args.append:
+        # Checked before rendering so frames are not rendered for a video they can not be added to.
+        try:
+            segmented = SegmentedVideo(vid_full_file_path, args.frames, args.encoder, args.preset, args.crf)
+        except ValueError as e:
+            print("error. " + str(e) + " exiting")
+            exit()
+    if args.startdate is not None and args.enddate is not None:
+        if args.startdate > args.enddate:
+            print("error. start date greater than end date. exiting")
+            exit()
+        if args.enddate < args.startdate:
+            print("error. end date less than start date. exiting")
+            exit()
+    if args.startdate is not None:
+        start_time = pytz.utc.localize(args.startdate)
+    else:
+        start_time = first_datetime
+    if args.enddate is not None:
+        last_datetime = pytz.utc.localize(args.enddate)
+    time_increment = timedelta(minutes = int(args.interval))
+
+    get_map(map_full_file_path, args.map, bbox_mapbox)
+    map_plt = plt.imread(map_full_file_path)
+    if args.preview != 1:
+        map_plt = preview_map(map_plt, args.preview)
+    heatmap = None
+    if args.heatmap is not None:
+        # The sensor to grid cell weights are computed once for all frames.
+        heatmap = IDWGrid(sensors['Lon'], sensors['Lat'], bbox_plot, (map_plt.shape[0] // args.heatmap, map_plt.shape[1] // args.heatmap))
+    save_png = args.png or not args.stream
+    if save_png:
+        cleanup_files(images_path, args.no_warning, frame_prefix)
+    frame_times = []
+    while start_time <= last_datetime:
+        frame_times.append(start_time)
+        start_time = start_time + time_increment
+    if args.matrix or args.smooth > 1 or args.ffill > 0:
+        # The pivot is cached next to the data file and rebuilt when the data or frames change.
+        matrix_path = os.path.splitext(data_file_full_path)[0] + "_" + args.interval + "min.npz"
+        matrix_params = {
+            'data': data_file_full_path,
+            'modified': store_modified(data_file_full_path) if os.path.isdir(data_file_full_path) else os.path.getmtime(data_file_full_path),
+            'bbox': args.bbox,
+            'sensors': str(pd.util.hash_pandas_object(sensors, index=False).sum()),
+            'start': str(frame_times[0]),
+            'frames': len(frame_times),
+            'interval': args.interval
+            }
+        frame_index = SensorMatrix.load(matrix_path, matrix_params)
+        if frame_index is None:
+            frame_index = SensorMatrix.from_readings(readings, len(sensors), frame_times, time_increment)
+            frame_index.save(matrix_path, matrix_params)
+        else:
+            print("using cached sensor matrix " + matrix_path)
+        if args.smooth > 1:
+            frame_index = frame_index.smooth(args.smooth)
+        if args.ffill > 0:
+            frame_index = frame_index.ffill(args.ffill)
+    else:
+        frame_index = FrameIndex(readings, frame_times, time_increment, args.carry)
+    if args.every > 1:
+        frame_index = frame_index.every(args.every)
+    if frame_index.carried:
+        print(f"carried readings forward into {frame_index.carried} empty frames or sensor gaps.")
+    stream = None
+    if args.stream:
+        stream_path = vid_full_file_path
+        if args.append:
+            # The frames are streamed into the next segment of the video.
+            stream_path = segmented.next_path()
+        stream = VideoStream(stream_path, args.frames, encoder=args.encoder, preset=args.preset, crf=args.crf)
+    fig_num = render_frames(root_path, frame_index, sensors, map_plt, bbox_plot, args.label, args.range, args.marker, args.map, args.workers, stream, save_png, args.renderer, args.stamp, heatmap, args.preview, frame_prefix)
+    if stream is not None:
+        stats = stream.close()
+        if args.append and stats is not None:
+            segmented.add(stats)
+            print("appended %d frames to %s. %d frames in %d segments." % (
+                stats['frames'], vid_full_file_path, len(segmented), len(segmented.manifest['segments'])))
+    elif args.video or args.append:
+        generate_video(images_path, vid_full_file_path, args.frames, segments=args.segments, encoder=args.encoder, preset=args.preset, crf=args.crf, append=args.append, manifest=manifest_path(root_path, frame_prefix))
\ No newline at end of file
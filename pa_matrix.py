@@ -0,0 +1,128 @@
+'''Dense sensor x time bucket matrix of readings.
+
+   Each row is a sensor (its sensor_code) and each column a frame interval. A cell holds the mean reading of the
+   sensor in that interval, NaN if it did not report. Unlike FrameIndex, whose frames include readings at both
+   ends of their interval, a bucket is [start, start + interval) so every reading is in exactly one bucket.
+
+   Sensors that miss an interval make frames flicker. The matrix can be smoothed with a rolling mean over the
+   time buckets and gaps filled with the last reading for a bounded number of buckets, both vectorized over all
+   sensors. The raw matrix is cached in an .npz file and reused by runs over the same data.
+'''
+
+import json
+import os
+import numpy as np
+import pandas as pd
+from pa_frames import utc_datetime64
+
+
+class SensorMatrix:
+   '''Sensor x time bucket matrix. Frames are read from it by column with the same interface as FrameIndex.
+
+      Args:
+         values: (numpy array)
+            sensors x buckets, float32
+         frame_times: (list, datetime)
+            start time of each bucket
+         column: (str)
+            name of the reading column in the frames
+   '''
+   def __init__(self, values, frame_times, column='PM2.5_ATM_ug/m3'):
+      self.values = values
+      self.frame_times = list(frame_times)
+      self.column = column
+      self.carried = 0
+
+   @classmethod
+   def from_readings(cls, readings, sensor_count, frame_times, time_increment, column='PM2.5_ATM_ug/m3'):
+      '''Pivots compact readings into the matrix.
+
+         Args:
+            readings: (Pandas dataframe)
+               with sensor_code, created_at and the reading column
+            sensor_count: (int)
+            frame_times: (list, datetime)
+               start time of each bucket, time_increment apart
+            time_increment: (timedelta)
+            column: (str)
+
+         Returns:
+            (SensorMatrix)
+      '''
+      buckets = len(frame_times)
+      times = utc_datetime64(readings['created_at'])
+      start = utc_datetime64(frame_times[:1])[0] if buckets else np.datetime64(0, 'ns')
+      bucket = (times - start) // np.timedelta64(time_increment)
+      values = readings[column].to_numpy(dtype=np.float64)
+      keep = (bucket >= 0) & (bucket < buckets) & ~np.isnan(values)
+      cells = readings['sensor_code'].to_numpy(dtype=np.int64)[keep] * buckets + bucket[keep]
+      counts = np.bincount(cells, minlength=sensor_count * buckets)
+      sums = np.bincount(cells, weights=values[keep], minlength=sensor_count * buckets)
+      with np.errstate(invalid='ignore', divide='ignore'):
+         matrix = (sums / counts).astype(np.float32).reshape(sensor_count, buckets)
+      return cls(matrix, frame_times, column)
+
+   def smooth(self, window):
+      '''Returns the matrix with each cell the mean of the sensor's readings in the last window buckets, itself
+         included. Missing readings are left out of the mean. Cells with no reading stay missing.'''
+      present = ~np.isnan(self.values)
+      sums = np.cumsum(np.where(present, self.values, 0), axis=1, dtype=np.float64)
+      counts = np.cumsum(present, axis=1)
+      sums[:, window:] = sums[:, window:] - sums[:, :-window]
+      counts[:, window:] = counts[:, window:] - counts[:, :-window]
+      with np.errstate(invalid='ignore', divide='ignore'):
+         values = np.where(present, sums / counts, np.nan).astype(np.float32)
+      return SensorMatrix(values, self.frame_times, self.column)
+
+   def ffill(self, limit):
+      '''Returns the matrix with missing cells filled with the sensor's last reading up to limit buckets
+         after it.'''
+      buckets = np.arange(self.values.shape[1])
+      present = ~np.isnan(self.values)
+      last = np.maximum.accumulate(np.where(present, buckets, -1), axis=1)
+      fill = ~present & (last >= 0) & (buckets - last <= limit)
+      rows, columns = np.nonzero(fill)
+      values = self.values.copy()
+      values[rows, columns] = self.values[rows, last[rows, columns]]
+      matrix = SensorMatrix(values, self.frame_times, self.column)
+      matrix.carried = len(rows)
+      return matrix
+
+   def __len__(self):
+      return len(self.frame_times)
+
+   def frame(self, n):
+      '''Returns the sensors with a value in bucket n (from 0) as a readings table.'''
+      values = self.values[:, n]
+      codes = np.flatnonzero(~np.isnan(values))
+      return pd.DataFrame({'sensor_code': codes.astype(np.int32), self.column: values[codes]})
+
+   def label_time(self, n, stamp='frame'):
+      return self.frame_times[n]
+
+   def every(self, step):
+      '''Returns the matrix of every step-th bucket, starting with the first.'''
+      matrix = SensorMatrix(self.values[:, ::step], self.frame_times[::step], self.column)
+      matrix.carried = self.carried
+      return matrix
+
+   def run(self, first, last):
+      '''Returns the matrix of buckets first to last (from 0, inclusive).'''
+      return SensorMatrix(self.values[:, first:last + 1], self.frame_times[first:last + 1], self.column)
+
+   def save(self, path, params):
+      '''Writes the matrix and the parameters it was built with to an .npz file.'''
+      np.savez_compressed(
+         path, values=self.values, frame_times=utc_datetime64(self.frame_times), params=json.dumps(params)
+         )
+
+   @classmethod
+   def load(cls, path, params, column='PM2.5_ATM_ug/m3'):
+      '''Returns the matrix saved in path if it was built with the same parameters, otherwise None.'''
+      if not os.path.exists(path):
+         return None
+      with np.load(path) as saved:
+         if json.loads(str(saved['params'])) != params:
+            return None
+         frame_times = list(pd.DatetimeIndex(saved['frame_times']).tz_localize('UTC'))
+         return cls(saved['values'], frame_times, column)
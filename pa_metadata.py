@@ -0,0 +1,183 @@
+'''Local store of PurpleAir sensor metadata.
+
+   Sensor metadata from the PurpleAir API are kept in a single SQLite database in the metadata folder along with
+   the bounding boxes that have been queried. The sensors table has an index over latitude and longitude. A
+   bounding box that lies inside an area already queried is answered from the database without calling the
+   PurpleAir API.
+
+   Sensors are returned as lists in the PurpleAir API field order used by pa_get_df:
+      [sensor_index, name, latitude, longitude, primary_id_a, primary_key_a, primary_id_b, primary_key_b, location_type]
+
+Usage:
+   Import the sensor lists from the .txt metadata files written by earlier versions:
+      python pa_metadata.py --import
+'''
+
+import os
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+
+FIELDS = [
+   'sensor_index',
+   'name',
+   'latitude',
+   'longitude',
+   'primary_id_a',
+   'primary_key_a',
+   'primary_id_b',
+   'primary_key_b',
+   'location_type'
+   ]
+
+
+class MetadataStore:
+   '''SQLite store of sensor metadata and the bounding boxes they cover.
+
+      Args:
+         db_path: (str)
+            database file
+         max_age_days: (float)
+            covered areas older than this are fetched again. None to never expire.
+   '''
+   def __init__(self, db_path, max_age_days=None):
+      self.conn = sqlite3.connect(db_path)
+      self.max_age_days = max_age_days
+      with self.conn:
+         self.conn.execute('''CREATE TABLE IF NOT EXISTS sensors (
+            sensor_index INTEGER PRIMARY KEY,
+            name TEXT,
+            latitude REAL,
+            longitude REAL,
+            primary_id_a INTEGER,
+            primary_key_a TEXT,
+            primary_id_b INTEGER,
+            primary_key_b TEXT,
+            location_type INTEGER
+            )''')
+         self.conn.execute('CREATE INDEX IF NOT EXISTS sensors_lat_lon ON sensors (latitude, longitude)')
+         self.conn.execute('''CREATE TABLE IF NOT EXISTS coverage (
+            west REAL,
+            south REAL,
+            east REAL,
+            north REAL,
+            updated TEXT
+            )''')
+
+   def covers(self, bbox):
+      '''Returns True if the bounding box lies inside an area already stored.
+
+         Args:
+            bbox: (list, float)
+               bounding box in the format lon1 lat1 lon2 lat2 for the SW and NE corners
+      '''
+      west, south, east, north = [float(b) for b in bbox]
+      query = 'SELECT 1 FROM coverage WHERE west <= ? AND south <= ? AND east >= ? AND north >= ?'
+      params = [west, south, east, north]
+      if self.max_age_days is not None:
+         oldest = datetime.now(timezone.utc) - timedelta(days=self.max_age_days)
+         query += ' AND updated >= ?'
+         params.append(oldest.isoformat())
+      return self.conn.execute(query + ' LIMIT 1', params).fetchone() is not None
+
+   def sensors(self, bbox, location_type=0):
+      '''Returns the stored sensors within a bounding box.
+
+         Args:
+            bbox: (list, float)
+               bounding box in the format lon1 lat1 lon2 lat2 for the SW and NE corners
+            location_type: (int)
+               0 for outside sensors, 1 for inside sensors, None for all
+
+         Returns:
+            (list, list)
+      '''
+      west, south, east, north = [float(b) for b in bbox]
+      query = f'''SELECT {", ".join(FIELDS)} FROM sensors
+         WHERE latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?'''
+      params = [south, north, west, east]
+      if location_type is not None:
+         query += ' AND location_type = ?'
+         params.append(location_type)
+      rows = self.conn.execute(query + ' ORDER BY sensor_index', params).fetchall()
+      return [list(row) for row in rows]
+
+   def add(self, bbox, sensor_rows):
+      '''Stores the sensors returned by the PurpleAir API for a bounding box and records the box as covered.
+
+         Args:
+            bbox: (list, float)
+               bounding box in the format lon1 lat1 lon2 lat2 for the SW and NE corners
+            sensor_rows: (list, list)
+               sensors in the FIELDS order
+      '''
+      placeholders = ", ".join("?" * len(FIELDS))
+      with self.conn:
+         self.conn.executemany(
+            f'INSERT OR REPLACE INTO sensors ({", ".join(FIELDS)}) VALUES ({placeholders})',
+            [row[:len(FIELDS)] for row in sensor_rows]
+            )
+         self.conn.execute(
+            'INSERT INTO coverage (west, south, east, north, updated) VALUES (?, ?, ?, ?, ?)',
+            [float(b) for b in bbox] + [datetime.now(timezone.utc).isoformat()]
+            )
+
+   def close(self):
+      self.conn.close()
+
+
+def import_legacy_files(store, metadata_path):
+   '''Imports the sensor list .txt files written by earlier versions of pa_get_df. The bounding box is taken
+      from the file name "<prefix> lon1 lat1 lon2 lat2.txt". The files are only read once so
+      ast.literal_eval is acceptable here.
+
+      Args:
+         store: (MetadataStore)
+         metadata_path: (str)
+
+      Returns:
+         (int) number of files imported
+   '''
+   import ast
+   imported = 0
+   for name in sorted(os.listdir(metadata_path)):
+      if not name.endswith(".txt"):
+         continue
+      try:
+         bbox = [float(b) for b in name[:-4].split(" ")[-4:]]
+      except ValueError:
+         print(f"skipping {name}. no bounding box in file name.")
+         continue
+      with open(os.path.join(metadata_path, name), 'r') as f:
+         sensor_rows = ast.literal_eval(f.read())
+      store.add(bbox, sensor_rows)
+      imported += 1
+      print(f"imported {len(sensor_rows)} sensors from {name}")
+   return imported
+
+
+if __name__ == "__main__":
+   import argparse
+   import config
+
+   def get_arguments():
+      parser = argparse.ArgumentParser(
+      description='manage the local PurpleAir sensor metadata store.',
+      prog='pa_metadata',
+      usage='%(prog)s [--import]',
+      formatter_class=argparse.RawDescriptionHelpFormatter,
+      )
+      g=parser.add_argument_group(title='arguments',
+            description='''        --import    optional.  import .txt metadata files from the metadata folder.        ''')
+      g.add_argument('--import', action='store_true',
+                     dest='import_files',
+                     help=argparse.SUPPRESS)
+      args = parser.parse_args()
+      return(args)
+
+   args = get_arguments()
+   metadata_path = config.root_path + os.path.sep + config.metadata_folder
+   store = MetadataStore(metadata_path + os.path.sep + 'sensors.db')
+   if args.import_files:
+      import_legacy_files(store, metadata_path)
+   store.close()
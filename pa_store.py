@@ -0,0 +1,218 @@
+'''Columnar, partitioned storage for pa_get_df data frames.
+
+   Sensor readings are stored as a Parquet or Feather (Arrow IPC) dataset partitioned by the UTC date of
+   created_at and optionally by sensor name. Loading pushes the date range and bounding box filters down to
+   the dataset so only the partitions, row groups and columns that are needed are read.
+
+   Stores are folders in the Data folder named like the csv files, with a .parquet or .feather extension.
+
+   Requires pyarrow.
+
+Usage:
+   Convert an existing csv file:
+      python pa_store.py -c <csv file> [--format <parquet|feather>] [--ps]
+'''
+
+import os
+import json
+import shutil
+import uuid
+import pandas as pd
+try:
+   import pyarrow as pa
+   import pyarrow.dataset as ds
+except ImportError:
+   pa = None
+   ds = None
+
+
+STORE_INFO = '_store.json'
+FORMATS = {'parquet': 'parquet', 'feather': 'ipc'}
+
+
+def check_pyarrow():
+   if ds is None:
+      raise ImportError("pyarrow is required for parquet and feather data stores. python -m pip install pyarrow")
+
+
+def store_format(store_path):
+   '''Returns the storage format of a store from the store folder extension.'''
+   return 'feather' if store_path.endswith('.feather') else 'parquet'
+
+
+def read_store_info(store_path):
+   with open(os.path.join(store_path, STORE_INFO), 'r') as f:
+      return json.load(f)
+
+
+def store_modified(store_path):
+   '''Returns the newest modification time, in ns, of the files in a store. Appending to an existing date
+      partition changes the files inside it but not the mtime of the store folder.'''
+   return max(
+      (os.stat(os.path.join(folder, name)).st_mtime_ns for folder, _, names in os.walk(store_path) for name in names),
+      default=os.stat(store_path).st_mtime_ns
+      )
+
+
+def store_partitioning(partition_sensor):
+   fields = [('date', pa.string())]
+   if partition_sensor:
+      fields.append(('Sensor', pa.string()))
+   return ds.partitioning(pa.schema(fields), flavor='hive')
+
+
+def write_store(df, store_path, partition_sensor=False, append=False):
+   '''Writes a data frame of sensor readings to a partitioned store.
+
+      Args:
+         df: (Pandas dataframe)
+            sensor readings with a created_at column
+         store_path: (str)
+            store folder. The extension selects parquet or feather.
+         partition_sensor: (bool)
+            also partition the store by sensor name
+         append: (bool)
+            add the readings to an existing store instead of replacing it
+   '''
+   check_pyarrow()
+   if append and os.path.exists(os.path.join(store_path, STORE_INFO)):
+      partition_sensor = read_store_info(store_path)['partition_sensor']
+   elif os.path.exists(store_path):
+      shutil.rmtree(store_path)
+   fmt = store_format(store_path)
+   df = df.sort_values('created_at', kind='stable')
+   df = df.assign(date=pd.to_datetime(df['created_at'], utc=True).dt.strftime('%Y-%m-%d'))
+   table = pa.Table.from_pandas(df, preserve_index=False)
+   ds.write_dataset(
+      table,
+      store_path,
+      format=FORMATS[fmt],
+      partitioning=store_partitioning(partition_sensor),
+      basename_template="part-" + uuid.uuid4().hex + "-{i}." + fmt,
+      existing_data_behavior='overwrite_or_ignore'
+      )
+   info = {'format': fmt, 'partition_sensor': partition_sensor, 'columns': [c for c in df.columns if c != 'date']}
+   with open(os.path.join(store_path, STORE_INFO), 'w') as f:
+      json.dump(info, f)
+
+
+def to_utc(t):
+   t = pd.Timestamp(t)
+   if t.tzinfo is None:
+      return t.tz_localize('UTC')
+   return t.tz_convert('UTC')
+
+
+def read_store(store_path, start_time=None, end_time=None, bbox=None, columns=None):
+   '''Reads sensor readings from a store. The filters are pushed down to the dataset.
+
+      Args:
+         store_path: (str)
+         start_time: (datetime)
+            optional first reading time. naive times are UTC.
+         end_time: (datetime)
+            optional last reading time. naive times are UTC.
+         bbox: (list, float)
+            optional bounding box in the format lon1 lat1 lon2 lat2 for the SW and NE corners
+         columns: (list, str)
+            optional columns to read
+
+      Returns:
+         (Pandas dataframe)
+   '''
+   check_pyarrow()
+   info = read_store_info(store_path)
+   dataset = ds.dataset(
+      store_path,
+      format=FORMATS[info['format']],
+      partitioning=store_partitioning(info['partition_sensor'])
+      )
+   condition = None
+   filters = []
+   if start_time is not None:
+      start_time = to_utc(start_time)
+      filters.append(ds.field('date') >= start_time.strftime('%Y-%m-%d'))
+      filters.append(ds.field('created_at') >= pa.scalar(start_time, pa.timestamp('ns', 'UTC')))
+   if end_time is not None:
+      end_time = to_utc(end_time)
+      filters.append(ds.field('date') <= end_time.strftime('%Y-%m-%d'))
+      filters.append(ds.field('created_at') <= pa.scalar(end_time, pa.timestamp('ns', 'UTC')))
+   if bbox is not None:
+      filters.append(ds.field('Lon') >= bbox[0])
+      filters.append(ds.field('Lat') >= bbox[1])
+      filters.append(ds.field('Lon') <= bbox[2])
+      filters.append(ds.field('Lat') <= bbox[3])
+   for f in filters:
+      condition = f if condition is None else condition & f
+   if columns is None:
+      columns = info['columns']
+   table = dataset.to_table(columns=columns, filter=condition)
+   df = table.to_pandas()
+   return df.sort_values('created_at', kind='stable', ignore_index=True)
+
+
+def convert_csv(csv_path, store_path=None, fmt='parquet', partition_sensor=False, chunksize=1000000):
+   '''Converts a pa_get_df csv file to a store. The csv file is read in chunks.
+
+      Args:
+         csv_path: (str)
+         store_path: (str)
+            optional store folder. Defaults to the csv path with the format extension.
+         fmt: (str)
+            parquet or feather
+         partition_sensor: (bool)
+         chunksize: (int)
+            csv rows per chunk
+
+      Returns:
+         (str) store folder
+   '''
+   check_pyarrow()
+   if store_path is None:
+      store_path = os.path.splitext(csv_path)[0] + "." + fmt
+   append = False
+   for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+      chunk['created_at'] = pd.to_datetime(chunk['created_at'], utc=True)
+      write_store(chunk, store_path, partition_sensor, append)
+      append = True
+   return store_path
+
+
+if __name__ == "__main__":
+   import argparse
+
+   def get_arguments():
+      parser = argparse.ArgumentParser(
+      description='convert pa_get_df csv files to a partitioned parquet or feather store.',
+      prog='pa_store',
+      usage='%(prog)s [-c <csv>], [--format <format>], [--ps]',
+      formatter_class=argparse.RawDescriptionHelpFormatter,
+      )
+      g=parser.add_argument_group(title='arguments',
+            description='''    -c, --csv     required.  csv file to convert. path or file name in the Data folder.
+          --format                          optional.  parquet or feather.
+          --ps                              optional.  also partition by sensor.        ''')
+      g.add_argument('-c', '--csv',
+                     type=str,
+                     required=True,
+                     dest='csv',
+                     help=argparse.SUPPRESS)
+      g.add_argument('--format',
+                     type=str,
+                     default = 'parquet',
+                     choices = ['parquet', 'feather'],
+                     dest='format',
+                     help=argparse.SUPPRESS)
+      g.add_argument('--ps', action='store_true',
+                     dest='partition_sensor',
+                     help=argparse.SUPPRESS)
+      args = parser.parse_args()
+      return(args)
+
+   args = get_arguments()
+   csv_path = args.csv
+   if not os.path.exists(csv_path):
+      import config
+      csv_path = config.root_path + os.path.sep + config.data_folder + os.path.sep + csv_path
+   store_path = convert_csv(csv_path, fmt=args.format, partition_sensor=args.partition_sensor)
+   print(f"wrote {store_path}")